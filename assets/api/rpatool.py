@@ -6,9 +6,34 @@ from __future__ import print_function
 import sys
 import os
 import codecs
+import zlib
 import pickle
 import errno
+import re
+import fnmatch
 import random
+import io
+import mmap
+import struct
+import hashlib
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import csv
+from array import array
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 try:
     import pickle5 as pickle
 except:
@@ -37,9 +62,6 @@ if sys.version_info[0] >= 3:
         else:
             return data.encode('latin1')
 
-    def _unpickle(data):
-        # Specify latin1 encoding to prevent raw byte values from causing an ASCII decode error.
-        return pickle.loads(data, encoding='latin1')
 elif sys.version_info[0] == 2:
     def _unicode(text):
         if isinstance(text, unicode):
@@ -52,12 +74,952 @@ elif sys.version_info[0] == 2:
     def _unmangle(data):
         return data
 
-    def _unpickle(data):
-        return pickle.loads(data)
+# Callables the archive index pickle may reference, Python 3 pickles bytes prefixes as calls to these.
+def _index_bytes(*args):
+    if args:
+        raise ValueError('unexpected bytes() arguments in archive index')
+    return b''
+
+def _index_encode(text, encoding):
+    if type(text) is not str or encoding not in ('latin1', 'latin-1'):
+        raise ValueError('unexpected _codecs.encode() arguments in archive index')
+    return text.encode(encoding)
+
+_GLOB_MAGIC = re.compile(r'[*?[]')
+
+_INDEX_GLOBALS = {
+    ('_codecs', 'encode'): _index_encode,
+    ('__builtin__', 'bytes'): _index_bytes,
+    ('builtins', 'bytes'): _index_bytes,
+}
+
+# Unpickler for archive indexes, which refuses to look up anything but the callables above.
+class _IndexUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) not in _INDEX_GLOBALS:
+            raise ValueError('unexpected global {0}.{1} in archive index'.format(module, name))
+        return _INDEX_GLOBALS[(module, name)]
+
+# Read-only stream over an iterable of data chunks, so an index can be unpickled while it is being inflated.
+class _ChunkStream(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position >= len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.position = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        count = min(len(buffer), len(self.chunk) - self.position)
+        buffer[:count] = self.chunk[self.position:self.position + count]
+        self.position += count
+        return count
+
+# Decode an archive index from an iterable of inflated chunks, XORing offsets and lengths with key.
+# Only a dict of names to lists of (offset, length[, prefix]) tuples is accepted, anything else raises a ValueError:
+# untrusted archives can not make the unpickler run code, as it only resolves the globals in _INDEX_GLOBALS.
+def _unpickle_index(chunks, key = 0):
+    try:
+        obfuscated_indexes = _IndexUnpickler(io.BufferedReader(_ChunkStream(chunks), 1024 * 1024), encoding='latin1').load()
+    except (pickle.UnpicklingError, EOFError, AttributeError, IndexError, TypeError, KeyError, zlib.error) as e:
+        raise ValueError('malformed archive index: {0}'.format(e))
+    if type(obfuscated_indexes) is not dict:
+        raise ValueError('archive index is not a dictionary')
+
+    indexes = {}
+    try:
+        for name, entries in obfuscated_indexes.items():
+            if type(name) is not str or type(entries) is not list:
+                raise TypeError(name)
+            if len(entries) > 0 and len(entries[0]) == 2:
+                indexes[name] = [ (offset ^ key, length ^ key) for offset, length in entries ]
+            else:
+                indexes[name] = [ (offset ^ key, length ^ key, prefix) for offset, length, prefix in entries
+                    if type(prefix) is bytes or type(prefix) is str ]
+                if len(indexes[name]) != len(entries):
+                    raise TypeError(name)
+    except (TypeError, ValueError):
+        raise ValueError('unexpected entry in archive index')
+    return indexes
+
+# Walk a directory with os.scandir, yielding (archive name, path, size) for every file below it. Like os.walk, errors
+# reading a directory or file are passed to onerror(path, error), skipping it, and raised if onerror is None.
+def scan_files(name, path, onerror = None):
+    directories = [(name, path)]
+    while directories:
+        (name, path) = directories.pop()
+        try:
+            with os.scandir(path) as scan:
+                entries = list(scan)
+        except OSError as e:
+            if onerror is None:
+                raise
+            onerror(path, e)
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    directories.append((name + os.sep + entry.name, entry.path))
+                    continue
+                size = entry.stat().st_size
+            except OSError as e:
+                if onerror is None:
+                    raise
+                onerror(entry.path, e)
+                continue
+            yield (name + os.sep + entry.name, entry.path, size)
+
+# File object wrapper hashing everything written through it.
+class _HashingWriter(object):
+    def __init__(self, target):
+        self.target = target
+        self.hash = hashlib.blake2b(digest_size=20)
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.target.write(data)
+
+    def digest(self):
+        return self.hash.digest()
+
+# CRC32 with the interface of the hashlib objects, for quick integrity manifests.
+class _CRC32(object):
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{0:08x}'.format(self.value & 0xFFFFFFFF)
+
+# Algorithms integrity manifests can use.
+DIGEST_ALGORITHMS = ('blake2b', 'crc32')
+
+def new_digest(algorithm = 'blake2b'):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=20)
+    elif algorithm == 'crc32':
+        return _CRC32()
+    raise ValueError('unknown digest algorithm {0}'.format(algorithm))
+
+# Hash a file object, reading it into one buffer of chunk_size bytes. Returns (size, hexadecimal digest).
+def digest_stream(source, algorithm = 'blake2b', chunk_size = 1024 * 1024):
+    digest = new_digest(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    while True:
+        count = source.readinto(buffer)
+        if not count:
+            break
+        digest.update(view[:count])
+        size += count
+    return (size, digest.hexdigest())
+
+# Call function on every item in a pool of jobs threads, yielding (item, result, error) in the order of the items.
+# At most jobs * 4 items are in flight at once.
+def _ordered_map(function, items, jobs = 1):
+    if jobs <= 1:
+        for item in items:
+            try:
+                yield (item, function(item), None)
+            except Exception as e:
+                yield (item, None, e)
+        return
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(jobs) as pool:
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            # Bound the number of results held in memory while waiting to be handed out.
+            while len(pending) > jobs * 4:
+                (done, future) = pending.popleft()
+                error = future.exception()
+                yield (done, future.result() if error is None else None, error)
+        while pending:
+            (done, future) = pending.popleft()
+            error = future.exception()
+            yield (done, future.result() if error is None else None, error)
+
+# Write an integrity manifest, mapping file names to their (size, hexadecimal digest).
+def save_digest_manifest(path, algorithm, digests):
+    manifest = {
+        'algorithm': algorithm,
+        'files': dict((filename, { 'size': size, 'digest': digest }) for (filename, (size, digest)) in digests.items()),
+    }
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# Read an integrity manifest, returning (algorithm, { filename: (size, hexadecimal digest) }).
+def load_digest_manifest(path):
+    with open(path, 'r') as file:
+        manifest = json.load(file)
+    try:
+        algorithm = manifest['algorithm']
+        digests = dict((filename, (record['size'], record['digest'])) for (filename, record) in manifest['files'].items())
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('{0} is not an integrity manifest'.format(path))
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError('unknown digest algorithm {0} in integrity manifest {1}'.format(algorithm, path))
+    return (algorithm, digests)
+
+# Hash the files below a directory, such as an extraction, yielding (filename, size, digest, error) for the given
+# file names in a pool of jobs threads.
+def digest_directory(directory, filenames, algorithm = 'blake2b', jobs = 1):
+    def digest(filename):
+        with open(os.path.join(directory, filename), 'rb') as file:
+            return digest_stream(file, algorithm)
+
+    for (filename, result, error) in _ordered_map(digest, filenames, jobs):
+        if error is not None:
+            yield (filename, None, None, error)
+        else:
+            yield (filename, result[0], result[1], None)
+
+# Compare computed digests, (filename, size, digest, error) tuples, against the ones in an integrity manifest.
+# Yields (filename, problem) for every file in either, problem being None when the file matches, and 'changed',
+# 'missing' (listed in the manifest only), 'unexpected' (not listed in the manifest) or the read error otherwise.
+def verify_digests(expected, results):
+    seen = set()
+    for (filename, size, digest, error) in results:
+        seen.add(filename)
+        if filename not in expected:
+            yield (filename, 'unexpected')
+        elif isinstance(error, EnvironmentError) and error.errno == errno.ENOENT:
+            yield (filename, 'missing')
+        elif error is not None:
+            yield (filename, error)
+        elif expected[filename] != (size, digest):
+            yield (filename, 'changed')
+        else:
+            yield (filename, None)
+    for filename in sorted(set(expected) - seen):
+        yield (filename, 'missing')
+
+# Copy length bytes at offset in the file descriptor source into the file descriptor fd, letting the kernel copy them
+# with copy_file_range() or sendfile() where possible, and falling back to chunked reads. Neither file position is used
+# for reading, name is only used in error messages.
+def _copy_fd(source, offset, length, fd, name, chunk_size = 1024 * 1024):
+    for copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy is None:
+            continue
+        try:
+            while length > 0:
+                if copy is os.sendfile:
+                    copied = os.sendfile(fd, source, offset, min(length, 0x7FFFF000))
+                else:
+                    copied = copy(source, fd, min(length, 0x7FFFF000), offset)
+                if copied == 0:
+                    raise IOError(errno.EIO, 'unexpected end of file {0}'.format(_printable(name)))
+                offset += copied
+                length -= copied
+            return
+        except OSError as e:
+            # Not supported for these files (e.g. across file systems), try the next way.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                    errno.EBADF, errno.ENOTSOCK, errno.EPERM):
+                raise
+    while length > 0:
+        chunk = os.pread(source, min(length, chunk_size), offset)
+        if not chunk:
+            raise IOError(errno.EIO, 'unexpected end of file {0}'.format(_printable(name)))
+        os.write(fd, chunk)
+        offset += len(chunk)
+        length -= len(chunk)
+
+# A file added to the archive by its path on disk, which is only read when the archive is saved.
+class DiskFile(object):
+    def __init__(self, path, size = None):
+        self.path = path
+        # Open the file right away, so missing and unreadable files are reported when they are added.
+        with open(path, 'rb') as file:
+            self.size = os.fstat(file.fileno()).st_size if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    # Copy the file to a file object, returning the number of bytes written.
+    def copy(self, target, chunk_size):
+        length = 0
+        with open(self.path, 'rb') as file:
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                target.write(chunk)
+                length += len(chunk)
+        return length
+
+# Find the literal text a regular expression has to start with, used to narrow down a directory before matching.
+def _literal_prefix(pattern):
+    if '|' in pattern:
+        return ''
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    prefix = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            char = pattern[i + 1]
+            i += 1
+        elif char in '.^$*+?{}[]()\\':
+            # A quantifier makes the last literal character optional.
+            if char in '*?{':
+                prefix = prefix[:-1]
+            return prefix
+        if i + 1 < len(pattern) and pattern[i + 1] in '*?{':
+            return prefix
+        prefix += char
+        i += 1
+    return prefix
+
+class _TrieNode(object):
+    __slots__ = ('children', 'files')
+
+    def __init__(self):
+        self.children = {}
+        self.files = []
+
+# Directory tree over archive file names, to list directories and select files by prefix, glob pattern or regular
+# expression without going over every name in the archive.
+class PathTrie(object):
+    def __init__(self, names = ()):
+        self.root = _TrieNode()
+        for name in names:
+            self.insert(name)
+
+    def insert(self, name):
+        node = self.root
+        for part in name.split('/')[:-1]:
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _TrieNode()
+            node = child
+        node.files.append(name)
+
+    # Find the node of a directory, or None.
+    def find(self, directory):
+        node = self.root
+        directory = directory.strip('/')
+        if directory:
+            for part in directory.split('/'):
+                node = node.children.get(part)
+                if node is None:
+                    return None
+        return node
+
+    # All file names below a node.
+    def walk(self, node):
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for name in node.files:
+                yield name
+            nodes.extend(node.children.values())
+
+    # List the subdirectories and files directly in a directory.
+    def listdir(self, directory = ''):
+        node = self.find(directory)
+        if node is None:
+            raise IOError(errno.ENOENT, 'the requested directory {0} does not exist in the given Ren\'Py archive'.format(
+                _printable(directory)))
+        return (sorted(node.children.keys()), sorted(name.rsplit('/', 1)[-1] for name in node.files))
+
+    # Select file names starting with prefix.
+    def prefix(self, prefix):
+        (directory, _, _) = prefix.rpartition('/')
+        node = self.find(directory)
+        if node is None:
+            return
+        for name in self.walk(node):
+            if name.startswith(prefix):
+                yield name
+
+    # Select file names matching a glob pattern. Wildcards do not cross directories, except for a '**' component,
+    # which matches any number of them. A pattern without any '/' matches file names in any directory.
+    def glob(self, pattern):
+        if '/' not in pattern:
+            pattern = '**/' + pattern
+        seen = set()
+        for name in self._glob(self.root, pattern.split('/')):
+            if name not in seen:
+                seen.add(name)
+                yield name
+
+    def _glob(self, node, parts):
+        part = parts[0]
+        if part == '**':
+            if len(parts) == 1:
+                for name in self.walk(node):
+                    yield name
+                return
+            for name in self._glob(node, parts[1:]):
+                yield name
+            for child in node.children.values():
+                for name in self._glob(child, parts):
+                    yield name
+        elif len(parts) == 1:
+            for name in node.files:
+                if fnmatch.fnmatchcase(name.rsplit('/', 1)[-1], part):
+                    yield name
+        elif not _GLOB_MAGIC.search(part):
+            if part in node.children:
+                for name in self._glob(node.children[part], parts[1:]):
+                    yield name
+        else:
+            for (directory, child) in node.children.items():
+                if fnmatch.fnmatchcase(directory, part):
+                    for name in self._glob(child, parts[1:]):
+                        yield name
+
+    # Select file names matching a regular expression from their start.
+    def regex(self, pattern):
+        expression = re.compile(pattern)
+        for name in self.prefix(_literal_prefix(pattern)):
+            if expression.match(name):
+                yield name
+
+# Compact, read-mostly replacement for the dict of archive indexes: names are kept sorted in one UTF-8 blob, and offsets,
+# lengths and prefixes in array columns, with every distinct prefix stored once. Names are found by binary search.
+class CompactIndex(MutableMapping):
+    def __init__(self, indexes):
+        names = sorted((name.encode('utf-8', 'surrogatepass'), entries) for (name, entries) in indexes.items())
+
+        self.name_starts = array('I', [0])
+        self.entry_starts = array('I', [0])
+        self.offsets = array('Q')
+        self.lengths = array('Q')
+        # Prefix 0 marks entries without a prefix.
+        self.prefix_ids = array('I')
+        self.prefixes = [None]
+        prefix_pool = {}
+
+        blob = []
+        position = 0
+        for (name, entries) in names:
+            blob.append(name)
+            position += len(name)
+            self.name_starts.append(position)
+            for entry in entries:
+                self.offsets.append(entry[0])
+                self.lengths.append(entry[1])
+                if len(entry) == 3:
+                    if entry[2] not in prefix_pool:
+                        prefix_pool[entry[2]] = len(self.prefixes)
+                        self.prefixes.append(entry[2])
+                    self.prefix_ids.append(prefix_pool[entry[2]])
+                else:
+                    self.prefix_ids.append(0)
+            self.entry_starts.append(len(self.offsets))
+        self.names = b''.join(blob)
+
+        # Changes made after building the index.
+        self.changed = {}
+        self.deleted = set()
+
+    def name(self, i):
+        return self.names[self.name_starts[i]:self.name_starts[i + 1]]
+
+    # Find the position of a name in the sorted columns, or -1.
+    def find(self, name):
+        if name in self.deleted:
+            return -1
+        name = name.encode('utf-8', 'surrogatepass')
+        low = 0
+        high = len(self.name_starts) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.name_starts) - 1 and self.name(low) == name:
+            return low
+        return -1
+
+    def entries(self, i):
+        entries = []
+        for entry in range(self.entry_starts[i], self.entry_starts[i + 1]):
+            if self.prefix_ids[entry]:
+                entries.append((self.offsets[entry], self.lengths[entry], self.prefixes[self.prefix_ids[entry]]))
+            else:
+                entries.append((self.offsets[entry], self.lengths[entry]))
+        return entries
+
+    def __getitem__(self, name):
+        if name in self.changed:
+            return self.changed[name]
+        i = self.find(name)
+        if i < 0:
+            raise KeyError(name)
+        return self.entries(i)
+
+    def __contains__(self, name):
+        return name in self.changed or self.find(name) >= 0
+
+    def __setitem__(self, name, entries):
+        if self.find(name) >= 0:
+            self.deleted.add(name)
+        self.changed[name] = entries
+
+    def __delitem__(self, name):
+        if name in self.changed:
+            del self.changed[name]
+        elif self.find(name) >= 0:
+            self.deleted.add(name)
+        else:
+            raise KeyError(name)
+
+    def __iter__(self):
+        for i in range(len(self.name_starts) - 1):
+            name = self.name(i).decode('utf-8', 'surrogatepass')
+            if name not in self.deleted:
+                yield name
+        for name in list(self.changed.keys()):
+            yield name
+
+    def __len__(self):
+        return len(self.name_starts) - 1 - len(self.deleted) + len(self.changed)
+
+# Read-only, seekable file object over a file in an archive, which reads its range on demand. reader(position, buffer)
+# fills buffer with the file's data (past the prefix) from position on, returning the number of bytes read.
+class ArchiveEntry(io.RawIOBase):
+    def __init__(self, name, reader, length, prefix = b''):
+        self.name = name
+        self.reader = reader
+        self.length = length
+        self.prefix = prefix
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({0})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {0}'.format(offset))
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        buffer = memoryview(buffer).cast('B')
+        count = min(len(buffer), self.length - self.position)
+        if count <= 0:
+            return 0
+
+        done = 0
+        if self.position < len(self.prefix):
+            done = min(count, len(self.prefix) - self.position)
+            buffer[:done] = self.prefix[self.position:self.position + done]
+        if done < count:
+            done += self.reader(self.position + done - len(self.prefix), buffer[done:count])
+        self.position += done
+        return done
+
+# Measure a PNG file at start in data from its IHDR chunk up to its IEND chunk.
+def _png_length(data, start, end):
+    if data[start + 12:start + 16] != b'IHDR':
+        return None
+    position = data.find(b'IEND\xaeB`\x82', start + 16, end)
+    return position + 8 - start if position >= 0 else None
+
+# Measure a JPEG file at start in data by walking its markers up to the end of image marker. Entropy-coded data after a
+# start of scan marker runs up to the next 0xFF byte that is not stuffing (0xFF00) or a restart marker.
+def _jpeg_length(data, start, end):
+    position = start + 2
+    while position + 4 <= end:
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+        elif marker == 0xD9:
+            return position + 2 - start
+        elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            position += 2
+        else:
+            length = (data[position + 2] << 8) | data[position + 3]
+            if length < 2:
+                return None
+            position += 2 + length
+            if marker == 0xDA:
+                while True:
+                    position = data.find(b'\xff', position, end)
+                    if position < 0 or position + 1 >= end:
+                        return None
+                    following = data[position + 1]
+                    if following == 0xFF:
+                        position += 1
+                    elif following == 0x00 or 0xD0 <= following <= 0xD7:
+                        position += 2
+                    else:
+                        break
+    return None
+
+# Measure an Ogg stream at start in data by walking its pages, from its first page up to its last one, or up to where
+# the pages of the stream end if it is cut off.
+def _ogg_length(data, start, end):
+    position = start
+    serial = None
+    while position + 27 <= end and data[position:position + 4] == b'OggS':
+        (version, flags, granule, page_serial, sequence, checksum, segments) = struct.unpack_from('<BBqIIIB', data, position + 4)
+        if version != 0 or (serial is None and not flags & 2) or (serial is not None and page_serial != serial):
+            break
+        serial = page_serial
+        position += 27 + segments + sum(bytearray(data[position + 27:position + 27 + segments]))
+        if flags & 4:
+            return min(position, end) - start
+    return position - start if position > start else None
+
+# Measure a WebP file at start in data from its RIFF header.
+def _webp_length(data, start, end):
+    if data[start + 8:start + 12] != b'WEBP':
+        return None
+    length = struct.unpack_from('<I', data, start + 4)[0] + 8
+    return length if start + length <= end else None
+
+# Measure a TrueType or OpenType font at start in data from its table directory, the font ending with its last table.
+def _font_length(data, start, end):
+    if start + 12 > end:
+        return None
+    (tables, search_range) = struct.unpack_from('>HH', data, start + 4)
+    if not 0 < tables <= 64 or search_range != 16 << (tables.bit_length() - 1) or start + 12 + 16 * tables > end:
+        return None
+    length = 12 + 16 * tables
+    for i in range(tables):
+        (tag, checksum, offset, size) = struct.unpack_from('>4sIII', data, start + 12 + 16 * i)
+        if not all(32 <= c < 127 for c in bytearray(tag)):
+            return None
+        length = max(length, offset + size)
+    # Tables are padded to 4 bytes.
+    length = (length + 3) & ~3
+    return length if start + length <= end else None
+
+# Measure a compiled Ren'Py script at start in data from its slot table.
+def _rpc2_length(data, start, end):
+    position = start + 10
+    length = position - start
+    while position + 12 <= end:
+        (slot, offset, size) = struct.unpack_from('<III', data, position)
+        if slot == 0:
+            return length if start + length <= end else None
+        length = max(length, offset + size)
+        position += 12
+    return None
+
+# Measure a zlib stream at start in data holding a pickle, as compiled Ren'Py scripts of the old format do, by
+# inflating it up to its end.
+def _zlib_length(data, start, end):
+    try:
+        if not zlib.decompressobj().decompress(data[start:start + 256], 2).startswith(b'\x80'):
+            return None
+        decompressor = zlib.decompressobj()
+        position = start
+        while not decompressor.eof:
+            if position >= end:
+                return None
+            chunk = data[position:min(end, position + 1024 * 1024)]
+            decompressor.decompress(chunk)
+            position += len(chunk)
+        return position - len(decompressor.unused_data) - start
+    except zlib.error:
+        return None
+
+# Size of the window salvage_entries() first looks for signatures in after a file, and the size it grows up to.
+_SALVAGE_WINDOW = 4 * 1024
+_SALVAGE_WINDOW_MAX = 4 * 1024 * 1024
+
+# Signature, extension and measuring function of the file types salvage_entries() recovers.
+_SALVAGE_TYPES = (
+    (b'\x89PNG\r\n\x1a\n', 'png', _png_length),
+    (b'\xff\xd8\xff', 'jpg', _jpeg_length),
+    (b'OggS', 'ogg', _ogg_length),
+    (b'RIFF', 'webp', _webp_length),
+    (b'\x00\x01\x00\x00', 'ttf', _font_length),
+    (b'OTTO', 'otf', _font_length),
+    (b'RENPY RPC2', 'rpyc', _rpc2_length),
+    (b'\x78\x9c', 'rpyc', _zlib_length),
+    (b'\x78\x5e', 'rpyc', _zlib_length),
+    (b'\x78\xda', 'rpyc', _zlib_length),
+)
+
+# Find files in a damaged archive by their signatures, in data (a memory map or bytes) between start and end. Signatures
+# are looked for with find() in a window after the last file found, which grows while nothing is found, since files
+# usually follow each other; data inside files found is skipped. What every find() covered is remembered, so no byte is
+# searched twice for the same signature. Yields (offset, length, extension).
+def salvage_entries(data, start = 0, end = None):
+    if end is None:
+        end = len(data)
+    # Next occurrence of every signature, or -1 if it does not occur before the searched offset.
+    found = [ -1 ] * len(_SALVAGE_TYPES)
+    searched = [ start ] * len(_SALVAGE_TYPES)
+
+    position = start
+    window = _SALVAGE_WINDOW
+    while position < end:
+        limit = min(end, position + window)
+        candidate = None
+        for (i, (signature, extension, measure)) in enumerate(_SALVAGE_TYPES):
+            if found[i] < position and (found[i] >= 0 or searched[i] < limit):
+                found[i] = data.find(signature, max(position, searched[i]) if found[i] < 0 else position,
+                    min(end, limit + len(signature) - 1))
+                searched[i] = limit
+            if found[i] >= position and (candidate is None or found[i] < found[candidate]):
+                candidate = i
+
+        if candidate is None:
+            position = limit
+            window = min(window * 2, _SALVAGE_WINDOW_MAX)
+            continue
+        (signature, extension, measure) = _SALVAGE_TYPES[candidate]
+        length = measure(data, found[candidate], end)
+        if length:
+            yield (found[candidate], length, extension)
+            position = found[candidate] + length
+            window = _SALVAGE_WINDOW
+        else:
+            position = found[candidate] + 1
+
+# Columns of asset catalogs, see asset_metadata().
+CATALOG_FIELDS = ('name', 'size', 'type', 'width', 'height', 'codec', 'channels', 'sample_rate', 'duration', 'family')
+# Bytes read from the start of every file to tell its type, most formats have what we need in there too.
+CATALOG_HEAD_SIZE = 512
+# Bytes read from the end of Ogg streams to find their last page.
+CATALOG_TAIL_SIZE = 64 * 1024
+
+# Bit rates (kbit/s) and sample rates of MPEG audio layer III frames, for MPEG-1 and MPEG-2/2.5.
+_MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = (44100, 48000, 32000)
+
+# Read length bytes at offset in a seekable file object.
+def _read_at(source, offset, length):
+    source.seek(offset)
+    return source.read(length) or b''
+
+# Find the width and height of a JPEG image from its first start of frame marker.
+def _jpeg_size(source):
+    position = 2
+    while True:
+        marker = _read_at(source, position, 9)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        if marker[1] == 0xFF:
+            position += 1
+            continue
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            if len(marker) < 9:
+                return None
+            (height, width) = struct.unpack_from('>HH', marker, 5)
+            return (width, height)
+        if marker[1] in (0xD9, 0xDA):
+            return None
+        position += 2 + struct.unpack_from('>H', marker, 2)[0]
+
+# Find the last granule position of an Ogg stream from the last page in its tail.
+def _ogg_last_granule(source, size):
+    start = max(0, size - CATALOG_TAIL_SIZE)
+    tail = _read_at(source, start, size - start)
+    position = tail.rfind(b'OggS')
+    while position >= 0:
+        if position + 14 <= len(tail) and tail[position + 4] == 0:
+            return struct.unpack_from('<q', tail, position + 6)[0]
+        position = tail.rfind(b'OggS', 0, position)
+    return None
+
+# Find the family name of a TrueType or OpenType font in its name table, preferring Windows English names.
+def _font_family(source, head):
+    if head.startswith(b'ttcf'):
+        # Font collections: take the first font.
+        offset = struct.unpack_from('>I', head, 12)[0]
+        head = _read_at(source, offset, 12)
+    else:
+        offset = 0
+    tables = struct.unpack_from('>H', head, 4)[0]
+    directory = _read_at(source, offset + 12, 16 * tables)
+    for i in range(len(directory) // 16):
+        (tag, checksum, table, length) = struct.unpack_from('>4sIII', directory, 16 * i)
+        if tag == b'name':
+            break
+    else:
+        return None
+
+    data = _read_at(source, table, min(length, CATALOG_TAIL_SIZE))
+    (table_format, count, strings) = struct.unpack_from('>HHH', data)
+    names = {}
+    for i in range(min(count, (len(data) - 6) // 12)):
+        (platform, encoding, language, name, length, offset) = struct.unpack_from('>HHHHHH', data, 6 + 12 * i)
+        if name not in (1, 16):
+            continue
+        text = data[strings + offset:strings + offset + length]
+        text = text.decode('utf-16-be', 'replace') if platform in (0, 3) else text.decode('mac_roman', 'replace')
+        # Typographic family names beat legacy ones, Windows English names beat others.
+        rank = (name == 16, platform == 3 and language == 0x409)
+        if text and (name not in names or rank > names[name][0]):
+            names[name] = (rank, text)
+    if not names:
+        return None
+    return max(names.values())[1]
+
+# Describe an asset from its header, read from a seekable file object: its type ('png', 'jpeg', 'gif', 'webp', 'ogg',
+# 'wav', 'mp3', 'ttf' or 'otf', or None), image width and height, audio codec, channels, sample rate and duration in
+# seconds, and font family. Only the first CATALOG_HEAD_SIZE bytes are read, plus the few bytes further in some formats
+# keep what we need in, and the tail of Ogg streams. Returns a dict with the CATALOG_FIELDS besides name.
+def asset_metadata(source):
+    size = source.seek(0, io.SEEK_END)
+    head = _read_at(source, 0, CATALOG_HEAD_SIZE)
+    record = dict.fromkeys(CATALOG_FIELDS[2:])
+    record['size'] = size
+
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and len(head) >= 24:
+        record['type'] = 'png'
+        (record['width'], record['height']) = struct.unpack_from('>II', head, 16)
+    elif head.startswith(b'\xff\xd8'):
+        record['type'] = 'jpeg'
+        dimensions = _jpeg_size(source)
+        if dimensions is not None:
+            (record['width'], record['height']) = dimensions
+    elif head.startswith((b'GIF87a', b'GIF89a')) and len(head) >= 10:
+        record['type'] = 'gif'
+        (record['width'], record['height']) = struct.unpack_from('<HH', head, 6)
+    elif head.startswith(b'RIFF') and head[8:12] == b'WEBP' and len(head) >= 30:
+        record['type'] = 'webp'
+        if head[12:16] == b'VP8 ':
+            (width, height) = struct.unpack_from('<HH', head, 26)
+            (record['width'], record['height']) = (width & 0x3FFF, height & 0x3FFF)
+        elif head[12:16] == b'VP8L':
+            bits = struct.unpack_from('<I', head, 21)[0]
+            (record['width'], record['height']) = ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+        elif head[12:16] == b'VP8X':
+            record['width'] = (struct.unpack_from('<I', head[24:27] + b'\0')[0]) + 1
+            record['height'] = (struct.unpack_from('<I', head[27:30] + b'\0')[0]) + 1
+    elif head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        record['type'] = 'wav'
+        position = 12
+        byte_rate = None
+        while position + 8 <= size:
+            chunk = _read_at(source, position, 24)
+            (tag, length) = struct.unpack_from('<4sI', chunk)
+            if tag == b'fmt ' and len(chunk) >= 24:
+                (codec, record['channels'], record['sample_rate'], byte_rate) = struct.unpack_from('<HHII', chunk, 8)
+                record['codec'] = 'pcm' if codec == 1 else 'wav-{0:04x}'.format(codec)
+            elif tag == b'data':
+                if byte_rate:
+                    record['duration'] = min(length, size - position - 8) / float(byte_rate)
+                break
+            position += 8 + length + (length & 1)
+    elif head.startswith(b'OggS') and len(head) >= 28:
+        record['type'] = 'ogg'
+        packet = head[27 + head[26]:]
+        (rate, skip) = (None, 0)
+        if packet.startswith(b'\x01vorbis') and len(packet) >= 16:
+            record['codec'] = 'vorbis'
+            (record['channels'], record['sample_rate']) = struct.unpack_from('<BI', packet, 11)
+            rate = record['sample_rate']
+        elif packet.startswith(b'OpusHead') and len(packet) >= 16:
+            record['codec'] = 'opus'
+            (record['channels'], skip, record['sample_rate']) = struct.unpack_from('<BHI', packet, 9)
+            # Opus granule positions always count 48 kHz samples.
+            rate = 48000
+        elif packet.startswith(b'\x7fFLAC') and len(packet) >= 30:
+            record['codec'] = 'flac'
+            bits = struct.unpack_from('>Q', packet, 27)[0]
+            (record['sample_rate'], record['channels']) = (bits >> 44, ((bits >> 41) & 7) + 1)
+            rate = record['sample_rate']
+        granule = _ogg_last_granule(source, size) if rate else None
+        if granule is not None and granule >= skip:
+            record['duration'] = (granule - skip) / float(rate)
+    elif head.startswith(b'ID3') or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        record['type'] = 'mp3'
+        start = 0
+        if head.startswith(b'ID3') and len(head) >= 10:
+            start = 10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9])
+        frame = _read_at(source, start, 4)
+        if len(frame) == 4 and frame[0] == 0xFF and frame[1] & 0xE0 == 0xE0 and (frame[1] >> 1) & 3 == 1:
+            version = (frame[1] >> 3) & 3
+            (bitrate, rate) = (frame[2] >> 4, (frame[2] >> 2) & 3)
+            if rate < 3 and 0 < bitrate < 15:
+                record['codec'] = 'mp3'
+                record['sample_rate'] = _MP3_SAMPLE_RATES[rate] >> { 3: 0, 2: 1, 0: 2 }.get(version, 0)
+                record['channels'] = 1 if frame[3] >> 6 == 3 else 2
+                # Assume a constant bit rate.
+                kbits = _MP3_BITRATES[1 if version == 3 else 2][bitrate]
+                record['duration'] = (size - start) * 8 / (kbits * 1000.0)
+    elif head.startswith((b'\x00\x01\x00\x00', b'OTTO', b'true', b'ttcf')) and len(head) >= 16:
+        record['type'] = 'otf' if head.startswith(b'OTTO') else 'ttf'
+        try:
+            record['family'] = _font_family(source, head)
+        except struct.error:
+            pass
+
+    return record
+
+# Write an asset catalog, records with the CATALOG_FIELDS, as CSV, SQLite (a table named assets) or JSON, chosen by
+# the extension of path (.csv, .db/.sqlite/.sqlite3, anything else).
+def save_catalog(path, records):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.db', '.sqlite', '.sqlite3'):
+        if sqlite3 is None:
+            raise IOError(errno.ENOSYS, 'the sqlite3 module is not available')
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS assets (name TEXT PRIMARY KEY, size INTEGER, type TEXT, '
+                    'width INTEGER, height INTEGER, codec TEXT, channels INTEGER, sample_rate INTEGER, duration REAL, '
+                    'family TEXT)')
+                connection.executemany('INSERT OR REPLACE INTO assets VALUES ({0})'.format(', '.join('?' * len(CATALOG_FIELDS))),
+                    ([ record[field] for field in CATALOG_FIELDS ] for record in records))
+        finally:
+            connection.close()
+        return
+
+    with io.open(path + '.tmp', 'w', encoding='utf-8', newline='') as file:
+        if extension == '.csv':
+            writer = csv.DictWriter(file, CATALOG_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(list(records), file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
 
 class RenPyArchive:
     file = None
     handle = None
+    trie = None
+    lock = None
+    mapping = None
+    view = None
 
     files = {}
     indexes = {}
@@ -66,18 +1028,53 @@ class RenPyArchive:
     padlength = 0
     key = None
     verbose = False
+    use_mmap = False
+    index_cache = None
+    compact_index = False
+    # Copy files in the kernel when extracting, only available where pread() is.
+    kernel_copy = hasattr(os, 'pread')
 
     RPA2_MAGIC = 'RPA-2.0 '
     RPA3_MAGIC = 'RPA-3.0 '
     RPA3_2_MAGIC = 'RPA-3.2 '
 
+    # Name of the extraction manifest kept in output directories by incremental extraction.
+    MANIFEST_NAME = '.rpatool-manifest.json'
+
+    # Index cache files start with this, followed by INDEX_CACHE_HEADER.
+    INDEX_CACHE_MAGIC = b'RPAIDX1\n'
+    # Archive size, mtime (ns), key, path/header/names/prefixes blob lengths, name and entry counts.
+    INDEX_CACHE_HEADER = struct.Struct('<QqQIIIIII')
+    # Prefix length stored for index entries without a prefix.
+    INDEX_CACHE_NO_PREFIX = 0xFFFFFFFF
+
     # For backward compatibility, otherwise Python3-packed archives won't be read by Python2
     PICKLE_PROTOCOL = 2
-
-    def __init__(self, file = None, version = 3, padlength = 0, key = 0xDEADBEEF, verbose = False):
+    # Size of the compressed chunks the index is inflated in.
+    INDEX_CHUNK_SIZE = 64 * 1024
+    # Size of the chunks files are copied in when saving or extracting.
+    COPY_CHUNK_SIZE = 1024 * 1024
+    # Files at most MERGE_GAP bytes apart are read together by iter_entries(), up to MERGE_SIZE bytes at once.
+    MERGE_GAP = 64 * 1024
+    MERGE_SIZE = 4 * 1024 * 1024
+    # Largest added file read ahead by a thread pool when saving, bigger files are copied in chunks.
+    PREFETCH_SIZE = 4 * 1024 * 1024
+    # Smallest file aligned when saving with alignment, smaller files are packed together.
+    ALIGN_MIN_SIZE = 64 * 1024
+    # Layout policies files can be ordered by when saving.
+    LAYOUTS = ('path', 'size', 'trace')
+
+    def __init__(self, file = None, version = 3, padlength = 0, key = 0xDEADBEEF, verbose = False, use_mmap = False, index_cache = None, compact_index = False):
         self.padlength = padlength
         self.key = key
         self.verbose = verbose
+        self.use_mmap = use_mmap
+        self.lock = threading.Lock()
+        # Every archive needs its own storage, not the class-wide defaults.
+        self.files = {}
+        self.indexes = {}
+        self.index_cache = index_cache
+        self.compact_index = compact_index
 
         if file is not None:
             self.load(file)
@@ -85,8 +1082,39 @@ class RenPyArchive:
             self.version = version
 
     def __del__(self):
+        self.close()
+
+    # Close the archive file, keeping its index. reopen() makes its files readable again.
+    def close(self):
+        self.unmap()
         if self.handle is not None:
             self.handle.close()
+            self.handle = None
+
+    def reopen(self):
+        if self.handle is None:
+            self.handle = open(self.file, 'rb')
+            if self.use_mmap:
+                self.map()
+
+    # Map the opened archive into memory, so entries can be handed out as memoryview slices without copying.
+    def map(self):
+        self.unmap()
+        self.mapping = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+
+    # Release the memory map of the opened archive, if any.
+    def unmap(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # Slices handed out by read() are still alive; the map is closed once they are collected.
+                pass
+            self.mapping = None
 
     # Determine archive version.
     def get_version(self):
@@ -104,6 +1132,17 @@ class RenPyArchive:
 
         raise ValueError('the given file is not a valid Ren\'Py archive, or an unsupported version')
 
+    # Inflate the index of the opened archive starting at offset, in chunks.
+    def inflate_index(self, offset):
+        self.handle.seek(offset)
+        decompressor = zlib.decompressobj()
+        while not decompressor.eof:
+            chunk = self.handle.read(self.INDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
     # Extract file indexes from opened archive.
     def extract_indexes(self):
         self.handle.seek(0)
@@ -123,25 +1162,140 @@ class RenPyArchive:
                 for subkey in vals[3:]:
                     self.key ^= int(subkey, 16)
 
-            # Load in indexes.
-            self.handle.seek(offset)
-            contents = codecs.decode(self.handle.read(), 'zlib')
-            indexes = _unpickle(contents)
-
-            # Deobfuscate indexes.
+            # Load in and deobfuscate indexes.
             if self.version in [3, 3.2]:
-                obfuscated_indexes = indexes
-                indexes = {}
-                for i in obfuscated_indexes.keys():
-                    if len(obfuscated_indexes[i][0]) == 2:
-                        indexes[i] = [ (offset ^ self.key, length ^ self.key) for offset, length in obfuscated_indexes[i] ]
-                    else:
-                        indexes[i] = [ (offset ^ self.key, length ^ self.key, prefix) for offset, length, prefix in obfuscated_indexes[i] ]
+                indexes = _unpickle_index(self.inflate_index(offset), self.key)
+            else:
+                indexes = _unpickle_index(self.inflate_index(offset))
         else:
-            indexes = pickle.loads(codecs.decode(self.handle.read(), 'zlib'))
+            indexes = _unpickle_index(self.inflate_index(0))
 
         return indexes
 
+    # Path of the index cache file of the opened archive.
+    def index_cache_path(self):
+        name = hashlib.sha1(os.path.abspath(self.file).encode('utf-8')).hexdigest()
+        return os.path.join(self.index_cache, name + '.idx')
+
+    # Identify the opened archive for the index cache: its path, size, mtime and header line.
+    def index_cache_key(self):
+        stat = os.fstat(self.handle.fileno())
+        self.handle.seek(0)
+        return (os.path.abspath(self.file).encode('utf-8'), stat.st_size, stat.st_mtime_ns, self.handle.readline())
+
+    # Load deobfuscated indexes of the opened archive from the index cache, or None if they are not cached.
+    def load_index_cache(self):
+        (path, size, mtime, header) = self.index_cache_key()
+        try:
+            with open(self.index_cache_path(), 'rb') as file:
+                data = file.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            stream = io.BytesIO(data)
+
+            def take(length):
+                chunk = stream.read(length)
+                if len(chunk) != length:
+                    raise ValueError('truncated index cache')
+                return chunk
+
+            def take_array(typecode, count):
+                column = array(typecode)
+                column.frombytes(take(count * column.itemsize))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                return column
+
+            if take(len(self.INDEX_CACHE_MAGIC)) != self.INDEX_CACHE_MAGIC:
+                return None
+            (cached_size, cached_mtime, key, path_length, header_length, names_length, prefixes_length, name_count,
+                entry_count) = self.INDEX_CACHE_HEADER.unpack(take(self.INDEX_CACHE_HEADER.size))
+            if (cached_size, cached_mtime) != (size, mtime):
+                return None
+            if (take(path_length), take(header_length)) != (path, header):
+                return None
+
+            names = take(names_length).decode('utf-8').split('\0') if name_count else []
+            prefixes = take(prefixes_length)
+            counts = take_array('I', name_count)
+            offsets = take_array('Q', entry_count)
+            lengths = take_array('Q', entry_count)
+            prefix_lengths = take_array('I', entry_count)
+            if len(names) != name_count or sum(counts) != entry_count:
+                raise ValueError('corrupt index cache')
+        except (ValueError, struct.error) as e:
+            self.verbose_print('Ignoring index cache of {0}: {1}'.format(self.file, e))
+            return None
+
+        self.verbose_print('Loaded archive index from index cache...')
+        if self.version in [3, 3.2]:
+            self.key = key
+
+        indexes = {}
+        entry = 0
+        prefix_position = 0
+        for (name, count) in zip(names, counts):
+            entries = []
+            for _ in range(count):
+                prefix_length = prefix_lengths[entry]
+                if prefix_length == self.INDEX_CACHE_NO_PREFIX:
+                    entries.append((offsets[entry], lengths[entry]))
+                else:
+                    entries.append((offsets[entry], lengths[entry], prefixes[prefix_position:prefix_position + prefix_length]))
+                    prefix_position += prefix_length
+                entry += 1
+            indexes[name] = entries
+        return indexes
+
+    # Store deobfuscated indexes of the opened archive in the index cache. Failing to do so is not an error.
+    def save_index_cache(self):
+        (path, size, mtime, header) = self.index_cache_key()
+
+        names = []
+        counts = array('I')
+        offsets = array('Q')
+        lengths = array('Q')
+        prefix_lengths = array('I')
+        prefixes = []
+        for (name, entries) in self.indexes.items():
+            names.append(name)
+            counts.append(len(entries))
+            for entry in entries:
+                offsets.append(entry[0])
+                lengths.append(entry[1])
+                if len(entry) == 3:
+                    prefix = _unmangle(entry[2])
+                    prefix_lengths.append(len(prefix))
+                    prefixes.append(prefix)
+                else:
+                    prefix_lengths.append(self.INDEX_CACHE_NO_PREFIX)
+        names = '\0'.join(names).encode('utf-8')
+        prefixes = b''.join(prefixes)
+
+        columns = [counts, offsets, lengths, prefix_lengths]
+        if sys.byteorder != 'little':
+            for column in columns:
+                column.byteswap()
+
+        cache = self.index_cache_path()
+        try:
+            if not os.path.exists(self.index_cache):
+                os.makedirs(self.index_cache)
+            with open(cache + '.tmp', 'wb') as file:
+                file.write(self.INDEX_CACHE_MAGIC)
+                file.write(self.INDEX_CACHE_HEADER.pack(size, mtime, self.key or 0, len(path), len(header), len(names),
+                    len(prefixes), len(counts), len(offsets)))
+                for blob in (path, header, names, prefixes):
+                    file.write(blob)
+                for column in columns:
+                    file.write(column.tobytes())
+            os.replace(cache + '.tmp', cache)
+            self.verbose_print('Stored archive index in index cache {0}...'.format(cache))
+        except (IOError, OSError) as e:
+            self.verbose_print('Could not store archive index in index cache: {0}'.format(e))
+
     # Generate pseudorandom padding (for whatever reason).
     def generate_padding(self):
         length = random.randint(1, self.padlength)
@@ -168,11 +1322,75 @@ class RenPyArchive:
     def list(self):
         return list(self.indexes.keys()) + list(self.files.keys())
 
+    # Directory tree of the files in archive and internal storage, built when first needed.
+    def tree(self):
+        if self.trie is None:
+            self.trie = PathTrie(self.list())
+        return self.trie
+
+    # List the subdirectories and files directly in a directory of the archive.
+    def listdir(self, directory = ''):
+        return self.tree().listdir(_unicode(directory))
+
+    # Select files by 'prefix', 'glob' pattern or 'regex'.
+    def select(self, pattern, mode = 'prefix'):
+        pattern = _unicode(pattern)
+        if mode == 'prefix':
+            return list(self.tree().prefix(pattern))
+        elif mode == 'glob':
+            return list(self.tree().glob(pattern))
+        elif mode == 'regex':
+            return list(self.tree().regex(pattern))
+        raise ValueError('unknown selection mode {0}'.format(mode))
+
     # Check if a file exists in the archive.
     def has_file(self, filename):
         filename = _unicode(filename)
         return filename in self.indexes.keys() or filename in self.files.keys()
 
+    # Read files from archive and internal storage, yielding (filename, contents) in the order they are stored in the
+    # archive rather than in index order, for all files or only the selected ones. Runs of small files close to each
+    # other are read at once and split up, and the kernel is told which ranges are about to be read.
+    def iter_entries(self, selection = None):
+        if selection is None:
+            selection = self.list()
+        filenames = [ self.convert_filename(_unicode(filename)) for filename in selection ]
+
+        # Group files into reads, keeping files from internal storage and memory-mapped archives on their own.
+        groups = []
+        for filename in sorted(filenames, key=self.offset):
+            if filename not in self.files and filename in self.indexes and self.view is None and self.handle is not None:
+                (start, length, prefix) = self.entry_range(filename)
+                end = start + length
+                if groups and groups[-1][0] is not None and start >= groups[-1][1] \
+                        and start - groups[-1][1] <= self.MERGE_GAP and end - groups[-1][0] <= self.MERGE_SIZE:
+                    groups[-1][1] = end
+                    groups[-1][2].append((filename, start, end, prefix))
+                else:
+                    groups.append([start, end, [(filename, start, end, prefix)]])
+            else:
+                groups.append([None, None, [(filename, None, None, None)]])
+
+        advise = hasattr(os, 'posix_fadvise') and self.handle is not None
+        if advise:
+            os.posix_fadvise(self.handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        for (i, (start, end, entries)) in enumerate(groups):
+            # Have the kernel start reading the next group while we handle this one.
+            if advise and i + 1 < len(groups) and groups[i + 1][0] is not None:
+                os.posix_fadvise(self.handle.fileno(), groups[i + 1][0], groups[i + 1][1] - groups[i + 1][0],
+                    os.POSIX_FADV_WILLNEED)
+
+            if start is None:
+                yield (entries[0][0], self.read(entries[0][0]))
+                continue
+
+            self.verbose_print('Reading {0} files from data file {1}... (offset = {2}, length = {3} bytes)'.format(
+                len(entries), self.file, start, end - start))
+            data = self.read_range(start, end - start)
+            for (filename, entry_start, entry_end, prefix) in entries:
+                yield (filename, prefix + data[entry_start - start:entry_end - start])
+
     # Read file from archive or internal storage.
     def read(self, filename):
         filename = self.convert_filename(_unicode(filename))
@@ -190,20 +1408,414 @@ class RenPyArchive:
         # Check our simplified internal indexes first, in case someone wants to read a file they added before without saving, for some unholy reason.
         if filename in self.files:
             self.verbose_print('Reading file {0} from internal storage...'.format(_printable(filename)))
+            if isinstance(self.files[filename], DiskFile):
+                return self.files[filename].read()
             return self.files[filename]
         # We need to read the file from our open archive.
         else:
             # Read offset and length, seek to the offset and read the file contents.
-            if len(self.indexes[filename][0]) == 3:
-                (offset, length, prefix) = self.indexes[filename][0]
-            else:
-                (offset, length) = self.indexes[filename][0]
-                prefix = ''
+            (offset, length, prefix) = self.entry_range(filename)
 
             self.verbose_print('Reading file {0} from data file {1}... (offset = {2}, length = {3} bytes)'.format(
-                _printable(filename), self.file, offset, length))
+                _printable(filename), self.file, offset, length + len(prefix)))
+            # Memory-mapped archives hand out a zero-copy slice, only prefixed entries need a new bytes object.
+            if self.view is not None:
+                data = self.view[offset:offset + length]
+                if prefix:
+                    return prefix + data
+                return data
+            return prefix + self.read_range(offset, length)
+
+    # Write files from archive and internal storage, all or only the selected ones, into a 'tar' or uncompressed 'zip'
+    # archive on a file object. Files are read in archive order and streamed straight into the target, which does not
+    # need to be seekable.
+    def export(self, target, format = 'tar', selection = None):
+        if selection is None:
+            selection = self.list()
+        filenames = sorted((self.convert_filename(_unicode(filename)) for filename in selection), key=self.offset)
+        mtime = os.fstat(self.handle.fileno()).st_mtime if self.handle is not None else time.time()
+
+        if format == 'tar':
+            with tarfile.open(fileobj=target, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for filename in filenames:
+                    self.verbose_print('Exporting file {0}...'.format(_printable(filename)))
+                    with self.open(filename) as source:
+                        info = tarfile.TarInfo(filename)
+                        info.size = source.seek(0, io.SEEK_END)
+                        info.mtime = mtime
+                        info.mode = 0o644
+                        source.seek(0)
+                        tar.addfile(info, io.BufferedReader(source, self.COPY_CHUNK_SIZE) if isinstance(source, ArchiveEntry) else source)
+        elif format == 'zip':
+            with zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+                for filename in filenames:
+                    self.verbose_print('Exporting file {0}...'.format(_printable(filename)))
+                    with self.open(filename) as source:
+                        info = zipfile.ZipInfo(filename, time.localtime(mtime)[:6])
+                        info.file_size = source.seek(0, io.SEEK_END)
+                        source.seek(0)
+                        with archive.open(info, 'w', force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as destination:
+                            shutil.copyfileobj(source, destination, self.COPY_CHUNK_SIZE)
+        else:
+            raise ValueError('unknown export format {0}'.format(format))
+
+    # Hash a file from archive or internal storage, returning (size, hexadecimal digest). Memory-mapped archives are
+    # hashed in place, other files are read in chunks into one buffer.
+    def digest(self, filename, algorithm = 'blake2b'):
+        filename = self.convert_filename(_unicode(filename))
+        if self.view is not None and filename not in self.files and filename in self.indexes:
+            (offset, length, prefix) = self.entry_range(filename)
+            digest = new_digest(algorithm)
+            digest.update(prefix)
+            digest.update(self.view[offset:offset + length])
+            return (length + len(prefix), digest.hexdigest())
+        with self.open(filename) as source:
+            return digest_stream(source, algorithm, self.COPY_CHUNK_SIZE)
+
+    # Describe files from archive and internal storage, all or only the selected ones, with asset_metadata(), in a pool
+    # of jobs threads, reading just their headers. Yields (filename, record, error) in archive order, record holding the
+    # CATALOG_FIELDS, error being None on success.
+    def catalog(self, selection = None, jobs = 1):
+        if selection is None:
+            selection = self.list()
+        filenames = sorted((self.convert_filename(_unicode(filename)) for filename in selection), key=self.offset)
+
+        def describe(filename):
+            with self.open(filename) as source:
+                record = asset_metadata(source)
+            record['name'] = filename
+            return record
+
+        for (filename, record, error) in _ordered_map(describe, filenames, jobs):
+            yield (filename, record, error)
+
+    # Hash length bytes at offset in the opened archive as stored, returning the hexadecimal digest.
+    def digest_range(self, offset, length, algorithm = 'blake2b'):
+        digest = new_digest(algorithm)
+        if self.view is not None:
+            digest.update(self.view[offset:offset + length])
+            return digest.hexdigest()
+        buffer = bytearray(min(length, self.COPY_CHUNK_SIZE))
+        view = memoryview(buffer)
+        while length > 0:
+            count = self.readinto_range(offset, view[:min(length, len(buffer))])
+            if not count:
+                raise IOError(errno.EIO, 'unexpected end of archive file {0}'.format(_printable(self.file)))
+            digest.update(view[:count])
+            offset += count
+            length -= count
+        return digest.hexdigest()
+
+    # Hash files from archive and internal storage, all or only the selected ones, in a pool of jobs threads.
+    # Yields (filename, size, digest, error) in archive order, error being None on success.
+    def digests(self, selection = None, algorithm = 'blake2b', jobs = 1):
+        if selection is None:
+            selection = self.list()
+        filenames = sorted((self.convert_filename(_unicode(filename)) for filename in selection), key=self.offset)
+        for (filename, result, error) in _ordered_map(lambda filename: self.digest(filename, algorithm), filenames, jobs):
+            if error is not None:
+                yield (filename, None, None, error)
+            else:
+                yield (filename, result[0], result[1], None)
+
+    # Open a file from archive or internal storage as a read-only file object, reading the file as it goes.
+    def open(self, filename):
+        filename = self.convert_filename(_unicode(filename))
+
+        if filename in self.files:
+            if isinstance(self.files[filename], DiskFile):
+                return io.open(self.files[filename].path, 'rb')
+            return io.BytesIO(self.files[filename])
+        if filename not in self.indexes or self.handle is None:
+            raise IOError(errno.ENOENT, 'the requested file {0} does not exist in the given Ren\'Py archive'.format(
+                _printable(filename)))
+
+        (offset, length, prefix) = self.entry_range(filename)
+        return ArchiveEntry(filename, lambda position, buffer: self.readinto_range(offset + position, buffer),
+            length + len(prefix), prefix)
+
+    # Read into a buffer from offset in the opened archive, returning the number of bytes read. Like read_range(), this
+    # does not use the shared position of the archive handle where preadv() or pread() are available.
+    def readinto_range(self, offset, buffer):
+        if self.view is not None:
+            data = self.view[offset:offset + len(buffer)]
+        elif hasattr(os, 'preadv'):
+            return os.preadv(self.handle.fileno(), [buffer], offset)
+        else:
+            data = self.read_range(offset, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    # Read up to length bytes at offset in the opened archive. Where pread() is available this does not use the shared
+    # position of the archive handle, so one archive can serve readers in several threads; elsewhere reads take a lock.
+    def read_range(self, offset, length):
+        if hasattr(os, 'pread'):
+            fd = self.handle.fileno()
+            data = os.pread(fd, length, offset)
+            if len(data) == length or not data:
+                return data
+            # Very large reads come back in parts.
+            parts = [data]
+            while length > len(data):
+                length -= len(data)
+                offset += len(data)
+                data = os.pread(fd, length, offset)
+                if not data:
+                    break
+                parts.append(data)
+            return b''.join(parts)
+
+        with self.lock:
             self.handle.seek(offset)
-            return _unmangle(prefix) + self.handle.read(length - len(prefix))
+            return self.handle.read(length)
+
+    # Find where a file of the opened archive is stored, given its name as in the index: (offset, stored length, prefix).
+    # The stored length does not count the prefix, bytes kept in the index in front of the stored data, which is b''
+    # for files without one.
+    def entry_range(self, filename):
+        entry = self.indexes[filename][0]
+        prefix = _unmangle(entry[2]) if len(entry) == 3 else b''
+        return (entry[0], entry[1] - len(prefix), prefix)
+
+    # Get the offset of a file in the opened archive, files in internal storage sort first.
+    def offset(self, filename):
+        filename = self.convert_filename(_unicode(filename))
+        if filename in self.indexes:
+            return self.indexes[filename][0][0]
+        return -1
+
+    # Get the size of a file in archive or internal storage, from the index without reading it.
+    def size(self, filename):
+        filename = self.convert_filename(_unicode(filename))
+        if filename in self.files:
+            return len(self.files[filename])
+        if filename in self.indexes:
+            return self.indexes[filename][0][1]
+        raise IOError(errno.ENOENT, 'the requested file {0} does not exist in the given Ren\'Py archive'.format(
+            _printable(filename)))
+
+    # Describe where a file comes from for the extraction manifest: the archive and the entry's range in it.
+    def manifest_record(self, filename):
+        filename = self.convert_filename(_unicode(filename))
+        record = { 'archive': os.path.abspath(self.file) if self.file is not None else None, 'name': filename }
+        if filename not in self.files and filename in self.indexes:
+            (offset, length, prefix) = self.entry_range(filename)
+            record['offset'] = offset
+            record['length'] = length + len(prefix)
+            record['prefix'] = codecs.encode(prefix, 'hex').decode('ascii')
+        return record
+
+    # Load the extraction manifest of a directory, mapping output files to their manifest records.
+    def load_manifest(self, output):
+        try:
+            with open(os.path.join(output, self.MANIFEST_NAME), 'r') as file:
+                return json.load(file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_manifest(self, output, manifest):
+        path = os.path.join(output, self.MANIFEST_NAME)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    # Check if an earlier extraction of a file, described by old, is still current: the output file has to be there with
+    # the right size, and either come from the same archive range, or have the same digest as the archive entry. With
+    # checksum, the output file itself is always hashed, rather than trusting the digest recorded in old. Returns
+    # (unchanged, contents), contents being the entry if it had to be read, so a changed file is written from it.
+    def unchanged(self, old, record, path, checksum = False):
+        if old is None or 'digest' not in old or 'length' not in record:
+            return (False, None)
+        try:
+            if os.path.getsize(path) != old['size']:
+                return (False, None)
+        except OSError:
+            return (False, None)
+        if not checksum and all(old.get(field) == record[field] for field in ('archive', 'name', 'offset', 'length', 'prefix')):
+            return (True, None)
+        contents = self.read(record['name'])
+        digest = hashlib.blake2b(contents, digest_size=20).hexdigest()
+        if checksum:
+            try:
+                with open(path, 'rb') as file:
+                    (size, current) = digest_stream(file)
+            except (IOError, OSError):
+                return (False, contents)
+        else:
+            current = old['digest']
+        return (current == digest, contents)
+
+    # Extract (outfile, filename) pairs into a directory, yielding (filename, error) for every file, error being None on success.
+    # Files are handed in archive order to a pool of jobs threads, which read and write them.
+    # With incremental, a manifest in the directory records what was extracted: files that are unchanged since the last
+    # run are skipped, and files that came from this archive but are no longer in it are deleted.
+    # A pool and set of already created directories can be passed in to share them between archives.
+    # Given a digests dict, the (size, digest) of every extracted file is stored in it by file name, hashed with algorithm
+    # from the same buffer the file is written from.
+    def extract(self, files, output, jobs = 1, incremental = False, checksum = False, pool = None, directories = None,
+            digests = None, algorithm = 'blake2b'):
+        jobs = max(1, jobs)
+        files = sorted(files, key=lambda pair: self.offset(pair[1]))
+        if directories is None:
+            directories = set()
+        manifest = self.load_manifest(output) if incremental else {}
+
+        def write(path, filename, record, contents = None):
+            if contents is None:
+                contents = self.read(filename)
+            with open(path, 'wb') as file:
+                file.write(contents)
+            if record is not None:
+                record['size'] = len(contents)
+                record['digest'] = hashlib.blake2b(contents, digest_size=20).hexdigest()
+            if digests is not None:
+                if algorithm == 'blake2b' and record is not None:
+                    digests[filename] = (record['size'], record['digest'])
+                else:
+                    digest = new_digest(algorithm)
+                    digest.update(contents)
+                    digests[filename] = (len(contents), digest.hexdigest())
+
+        def copy(path, span):
+            with open(path, 'wb') as file:
+                self.copy_range_fd(span[0], span[1], file.fileno())
+
+        def finish(outfile, record, error):
+            if record is not None:
+                if error is None:
+                    manifest[outfile] = record
+                elif outfile in manifest:
+                    del manifest[outfile]
+
+        shared_pool = pool is not None
+        if not shared_pool and jobs > 1:
+            pool = ThreadPoolExecutor(jobs)
+        pending = collections.deque()
+        try:
+            for (outfile, filename) in files:
+                record = self.manifest_record(filename) if incremental else None
+                contents = None
+                try:
+                    path = os.path.join(output, outfile)
+                    if incremental:
+                        (unchanged, contents) = self.unchanged(manifest.get(outfile), record, path, checksum)
+                    if incremental and unchanged:
+                        self.verbose_print('Skipping unchanged file {0}...'.format(_printable(filename)))
+                        # Keep the record current, the file may have moved within the archive.
+                        record['size'] = manifest[outfile]['size']
+                        record['digest'] = manifest[outfile]['digest']
+                        manifest[outfile] = record
+                        if digests is not None:
+                            digests[filename] = (record['size'], record['digest']) if algorithm == 'blake2b' \
+                                else self.digest(filename, algorithm)
+                        yield (filename, None)
+                        continue
+
+                    # Files stored as is can be copied by the kernel, unless we need their digest.
+                    span = self.plain_range(filename) if self.kernel_copy and record is None and digests is None else None
+
+                    # Create output directory for file if not present, only once per directory.
+                    directory = os.path.dirname(path)
+                    if directory not in directories:
+                        if not os.path.exists(directory):
+                            os.makedirs(directory)
+                        directories.add(directory)
+
+                    if span is not None:
+                        self.verbose_print('Copying file {0} from data file {1}... (offset = {2}, length = {3} bytes)'.format(
+                            _printable(filename), self.file, span[0], span[1]))
+                        if pool is None:
+                            copy(path, span)
+                        else:
+                            pending.append((filename, outfile, record, pool.submit(copy, path, span)))
+                    elif pool is None:
+                        write(path, filename, record, contents)
+                    else:
+                        # Reads do not share a file position, so the threads read files themselves too.
+                        pending.append((filename, outfile, record, pool.submit(write, path, filename, record, contents)))
+                except Exception as e:
+                    finish(outfile, record, e)
+                    yield (filename, e)
+                    continue
+
+                if pool is None:
+                    finish(outfile, record, None)
+                    yield (filename, None)
+                # Bound the number of files held in memory while waiting to be written.
+                while len(pending) > jobs * 4:
+                    (done, outfile, record, future) = pending.popleft()
+                    finish(outfile, record, future.exception())
+                    yield (done, future.exception())
+
+            while pending:
+                (done, outfile, record, future) = pending.popleft()
+                finish(outfile, record, future.exception())
+                yield (done, future.exception())
+        finally:
+            if pool is not None and not shared_pool:
+                pool.shutdown()
+
+        if incremental:
+            # Delete files extracted from this archive before, that are no longer in it.
+            archive = os.path.abspath(self.file) if self.file is not None else None
+            for (outfile, record) in list(manifest.items()):
+                if record.get('archive') == archive and not self.has_file(record['name']):
+                    self.verbose_print('Removing file {0}, which is no longer in the archive...'.format(_printable(outfile)))
+                    try:
+                        os.remove(os.path.join(output, outfile))
+                    except OSError:
+                        pass
+                    del manifest[outfile]
+            self.save_manifest(output, manifest)
+
+    # Find the (offset, length) of a file stored in the opened archive as is, without a prefix, or None.
+    def plain_range(self, filename):
+        filename = self.convert_filename(_unicode(filename))
+        if filename in self.files or filename not in self.indexes or self.handle is None:
+            return None
+        (offset, length, prefix) = self.entry_range(filename)
+        if prefix:
+            return None
+        return (offset, length)
+
+    # Copy length bytes at offset in the opened archive into a file descriptor, letting the kernel copy them with
+    # copy_file_range() or sendfile() where possible, and falling back to chunked reads.
+    # This never moves the position of the archive handle, so it can be used from several threads at once.
+    def copy_range_fd(self, offset, length, fd):
+        _copy_fd(self.handle.fileno(), offset, length, fd, self.file, self.COPY_CHUNK_SIZE)
+
+    # Copy length bytes at offset in the opened archive to a file object, COPY_CHUNK_SIZE bytes at a time.
+    def copy_range(self, offset, length, target):
+        while length > 0:
+            chunk = self.read_range(offset, min(length, self.COPY_CHUNK_SIZE))
+            if not chunk:
+                raise IOError(errno.EIO, 'unexpected end of archive file {0}'.format(_printable(self.file)))
+            target.write(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+
+    # Copy a file from archive or internal storage to a file object, without reading it into memory at once.
+    # Returns the number of bytes written.
+    def copy(self, filename, target):
+        filename = self.convert_filename(_unicode(filename))
+
+        if filename in self.files:
+            contents = self.files[filename]
+            if isinstance(contents, DiskFile):
+                return contents.copy(target, self.COPY_CHUNK_SIZE)
+            target.write(contents)
+            return len(contents)
+        elif filename in self.indexes and self.handle is not None:
+            (offset, length, prefix) = self.entry_range(filename)
+
+            self.verbose_print('Copying file {0} from data file {1}... (offset = {2}, length = {3} bytes)'.format(
+                _printable(filename), self.file, offset, length + len(prefix)))
+            target.write(prefix)
+            self.copy_range(offset, length, target)
+            return length + len(prefix)
+
+        raise IOError(errno.ENOENT, 'the requested file {0} does not exist in the given Ren\'Py archive'.format(
+            _printable(filename)))
 
     # Modify a file in archive or internal storage.
     def change(self, filename, contents):
@@ -222,10 +1834,12 @@ class RenPyArchive:
         self.verbose_print('Adding file {0} to archive... (length = {1} bytes)'.format(
             _printable(filename), len(contents)))
         self.files[filename] = contents
+        self.trie = None
 
     # Remove a file from archive or internal storage.
     def remove(self, filename):
         filename = _unicode(filename)
+        self.trie = None
         if filename in self.files:
             self.verbose_print('Removing file {0} from internal storage...'.format(_printable(filename)))
             del self.files[filename]
@@ -239,78 +1853,740 @@ class RenPyArchive:
     def load(self, filename):
         filename = _unicode(filename)
 
+        self.unmap()
         if self.handle is not None:
             self.handle.close()
         self.file = filename
         self.files = {}
+        self.trie = None
         self.handle = open(self.file, 'rb')
         self.version = self.get_version()
-        self.indexes = self.extract_indexes()
+        if self.index_cache is not None:
+            self.indexes = self.load_index_cache()
+            if self.indexes is None:
+                self.indexes = self.extract_indexes()
+                self.save_index_cache()
+        else:
+            self.indexes = self.extract_indexes()
+        if self.compact_index:
+            self.indexes = CompactIndex(self.indexes)
+        if self.use_mmap:
+            self.map()
+
+    # Open an archive with a damaged or missing index, recovering its files from their signatures with salvage_entries()
+    # instead of reading the index. Files are looked for between the header and the index offset it gives, if any, and
+    # named salvaged/<offset>.<extension>, with the offset in hexadecimal.
+    def salvage(self, filename):
+        filename = _unicode(filename)
+
+        self.unmap()
+        if self.handle is not None:
+            self.handle.close()
+        self.file = filename
+        self.files = {}
+        self.trie = None
+        self.handle = open(self.file, 'rb')
+        size = os.fstat(self.handle.fileno()).st_size
+        if size == 0:
+            raise ValueError('the given file {0} is empty'.format(_printable(filename)))
+
+        (start, end) = (0, size)
+        try:
+            self.version = self.get_version()
+        except (ValueError, UnicodeDecodeError):
+            self.version = 3
+        else:
+            self.handle.seek(0)
+            metadata = self.handle.readline()
+            try:
+                (start, end) = (len(metadata), min(size, int(metadata.split()[1], 16)))
+            except (IndexError, ValueError):
+                start = len(metadata)
+            if end <= start:
+                end = size
+
+        self.map()
+        self.indexes = {}
+        for (offset, length, extension) in salvage_entries(self.mapping, start, end):
+            self.indexes['salvaged/{0:010x}.{1}'.format(offset, extension)] = [ (offset, length) ]
+        self.verbose_print('Recovered {0} files from data file {1}.'.format(len(self.indexes), self.file))
+
+    # Length of the header of version 2 and 3 archives written by us.
+    def header_length(self):
+        if self.version == 3:
+            return 34
+        elif self.version == 2:
+            return 25
+        raise ValueError('saving is only supported for version 2 and 3 archives')
+
+    # Build the header pointing at the index at offset.
+    def build_header(self, offset):
+        if self.version == 3:
+            return codecs.encode('{}{:016x} {:08x}\n'.format(self.RPA3_MAGIC, offset, self.key))
+        return codecs.encode('{}{:016x}\n'.format(self.RPA2_MAGIC, offset))
+
+    # Obfuscate index entries for writing, the reverse of what extract_indexes() does.
+    def obfuscate_index(self, entries):
+        if self.version != 3:
+            return list(entries)
+        return [ (entry[0] ^ self.key, entry[1] ^ self.key) + tuple(entry[2:]) for entry in entries ]
+
+    # Leave out an added file on disk that could not be read while saving, e.g. as it was deleted after being added,
+    # dropping whatever was written of it from start on. Skipped files are kept in skipped_files as (filename, error).
+    def skip_file(self, filename, error, archive, start):
+        self.verbose_print('Skipping file {0}, which could not be read...'.format(_printable(filename)))
+        self.skipped_files.append((filename, error))
+        archive.seek(start)
+        archive.truncate()
+
+    # Save current state into the opened archive in place: added files and a new index are appended to the archive,
+    # and only the header is rewritten. Data of removed files is left behind until the archive is compacted with save().
+    def save_in_place(self):
+        if self.handle is None:
+            raise ValueError('no opened archive to save in place')
+        if self.version != 2 and self.version != 3:
+            raise ValueError('saving in place is only supported for version 2 and 3 archives')
+
+        # The new header has to fit exactly over the old one.
+        self.handle.seek(0)
+        if len(self.handle.readline()) != self.header_length():
+            raise ValueError('the archive header has a non-standard length, the archive can not be saved in place')
+
+        self.unmap()
+        with open(self.file, 'r+b') as archive:
+            # Append after the old index, so the archive stays valid until the header is patched.
+            archive.seek(0, os.SEEK_END)
+            offset = archive.tell()
+
+            indexes = {}
+            for file, entries in self.indexes.items():
+                indexes[file] = self.obfuscate_index(entries)
+
+            self.verbose_print('Appending files to archive file...')
+            self.skipped_files = []
+            for file in list(self.files.keys()):
+                start = offset
+                if self.padlength > 0:
+                    padding = self.generate_padding()
+                    archive.write(padding)
+                    offset += len(padding)
+
+                try:
+                    length = self.copy(file, archive)
+                except (IOError, OSError) as e:
+                    if not isinstance(self.files[file], DiskFile):
+                        raise
+                    self.skip_file(file, e, archive, start)
+                    offset = start
+                    continue
+                indexes[file] = self.obfuscate_index([ (offset, length) ])
+                offset += length
+
+            self.verbose_print('Appending archive index to archive file...')
+            archive.write(codecs.encode(pickle.dumps(indexes, self.PICKLE_PROTOCOL), 'zlib'))
+            archive.flush()
+            os.fsync(archive.fileno())
+
+            self.verbose_print('Patching header of archive file... (version = RPAv{0})'.format(self.version))
+            archive.seek(0)
+            archive.write(self.build_header(offset))
+
+        # Reload the file in our inner database.
+        self.load(self.file)
+
+    # Read added files of at most PREFETCH_SIZE bytes ahead of writing them, on a pool of jobs threads, hashing them too
+    # for dedup. Yields (filename, (contents, digest)) in order, or (filename, None) for files that are copied as they are.
+    def prefetch(self, files, jobs = 1, dedup = False):
+        if jobs <= 1:
+            for file in files:
+                yield (file, None)
+            return
+
+        def load(file):
+            contents = self.files.get(file)
+            if not isinstance(contents, DiskFile) or contents.size > self.PREFETCH_SIZE:
+                return None
+            try:
+                data = contents.read()
+            except (IOError, OSError):
+                # Leave it to save() to copy the file, and skip it if it still can not be read.
+                return None
+            return (data, hashlib.blake2b(data, digest_size=20).digest() if dedup else None)
+
+        for (file, prefetched, error) in _ordered_map(load, files, jobs):
+            if error is not None:
+                raise error
+            yield (file, prefetched)
+
+    # Order files by a layout policy for saving: 'path' groups files by directory and then by type, 'size' stores small
+    # files first, so they are read together, and 'trace' follows trace, a list of file names in the order they are
+    # accessed, with the files not in it after them, grouped by path.
+    def layout(self, files, policy = 'path', trace = None):
+        def by_path(file):
+            (directory, _, name) = file.rpartition('/')
+            return (directory, os.path.splitext(name)[1].lower(), name)
+
+        if policy == 'path':
+            return sorted(files, key=by_path)
+        elif policy == 'size':
+            return sorted(files, key=lambda file: (self.size(file), by_path(file)))
+        elif policy == 'trace':
+            order = {}
+            for file in trace or ():
+                order.setdefault(self.convert_filename(_unicode(file)), len(order))
+            return sorted(files, key=lambda file: (order.get(file, len(order)), by_path(file)))
+        raise ValueError('unknown layout policy {0}'.format(policy))
+
+    # Read files one at a time in the given order, as a game would, after asking the kernel to drop the archive from
+    # the page cache where possible. Returns (seconds, bytes read, jumps), jumps counting the reads that go back, or skip
+    # ahead more than MERGE_GAP bytes, from where the one before ended; small gaps such as alignment padding do not count.
+    def benchmark(self, files):
+        if hasattr(os, 'posix_fadvise') and self.handle is not None:
+            os.posix_fadvise(self.handle.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        (size, jumps, position) = (0, 0, None)
+        start = time.time()
+        for file in files:
+            file = self.convert_filename(_unicode(file))
+            size += len(self.read(file))
+            if file in self.indexes:
+                (offset, length, prefix) = self.entry_range(file)
+                if position is not None and not position <= offset <= position + self.MERGE_GAP:
+                    jumps += 1
+                position = offset + length
+        return (time.time() - start, size, jumps)
 
     # Save current state into a new file, merging archive and internal storage, rebuilding indexes, and optionally saving in another format version.
-    def save(self, filename = None):
+    # Files are streamed into the new archive in chunks, so memory use does not grow with the size of the archive.
+    # Files are stored in archive order, followed by added files, unless ordered by a layout policy (see layout()), and
+    # files of at least ALIGN_MIN_SIZE bytes start at a multiple of align bytes if given, e.g. the page size for mmap.
+    def save(self, filename = None, dedup = False, jobs = 1, layout = None, trace = None, align = 0):
         filename = _unicode(filename)
 
         if filename is None:
             filename = self.file
         if filename is None:
             raise ValueError('no target file found for saving archive')
-        if self.version != 2 and self.version != 3:
-            raise ValueError('saving is only supported for version 2 and 3 archives')
-
-        self.verbose_print('Rebuilding archive index...')
-        # Fill our own files structure with the files added or changed in this session.
-        files = self.files
-        # First, read files from the current archive into our files structure.
-        for file in list(self.indexes.keys()):
-            content = self.read(file)
-            # Remove from indexes array once read, add to our own array.
-            del self.indexes[file]
-            files[file] = content
 
         # Predict header length, we'll write that one last.
-        offset = 0
-        if self.version == 3:
-            offset = 34
-        elif self.version == 2:
-            offset = 25
-        archive = open(filename, 'wb')
-        archive.seek(offset)
+        offset = self.header_length()
+        # With dedup, files with the same contents share one copy in the archive, keyed by (length, digest).
+        written = {}
+        # Files sharing a range of the archive we read from keep sharing it, keyed by entry_range(), dedup or not.
+        copied = {}
+        self.deduplicated_files = 0
+        self.deduplicated_bytes = 0
+        self.skipped_files = []
+
+        # Write to a temporary file next to the target, as the target may well be the archive we are reading from.
+        temporary = filename + '.tmp'
+        try:
+            with open(temporary, 'wb') as archive:
+                archive.seek(offset)
 
-        # Build our own indexes while writing files to the archive.
-        indexes = {}
-        self.verbose_print('Writing files to archive file...')
-        for file, content in files.items():
-            # Generate random padding, for whatever reason.
-            if self.padlength > 0:
-                padding = self.generate_padding()
-                archive.write(padding)
-                offset += len(padding)
-
-            archive.write(content)
-            # Update index.
-            if self.version == 3:
-                indexes[file] = [ (offset ^ self.key, len(content) ^ self.key) ]
-            elif self.version == 2:
-                indexes[file] = [ (offset, len(content)) ]
-            offset += len(content)
-
-        # Write the indexes.
-        self.verbose_print('Writing archive index to archive file...')
-        archive.write(codecs.encode(pickle.dumps(indexes, self.PICKLE_PROTOCOL), 'zlib'))
-        # Now write the header.
-        self.verbose_print('Writing header to archive file... (version = RPAv{0})'.format(self.version))
-        archive.seek(0)
-        if self.version == 3:
-            archive.write(codecs.encode('{}{:016x} {:08x}\n'.format(self.RPA3_MAGIC, offset, self.key)))
-        else:
-            archive.write(codecs.encode('{}{:016x}\n'.format(self.RPA2_MAGIC, offset)))
-        # We're done, close it.
-        archive.close()
+                # Build our own indexes while writing files to the archive.
+                indexes = {}
+                self.verbose_print('Writing files to archive file...')
+                files = sorted(self.indexes.keys(), key=self.offset) + list(self.files.keys())
+                if layout is not None:
+                    files = self.layout(files, layout, trace)
+                for (file, prefetched) in self.prefetch(files, jobs, dedup):
+                    source = self.entry_range(file) if file in self.indexes and file not in self.files else None
+                    if source in copied:
+                        self.verbose_print('File {0} shares its contents with another file...'.format(_printable(file)))
+                        indexes[file] = self.obfuscate_index([ copied[source] ])
+                        self.deduplicated_files += 1
+                        self.deduplicated_bytes += copied[source][1]
+                        continue
+
+                    start = offset
+                    # Generate random padding, for whatever reason.
+                    if self.padlength > 0:
+                        padding = self.generate_padding()
+                        archive.write(padding)
+                        offset += len(padding)
+                    if align > 1 and offset % align and self.size(file) >= self.ALIGN_MIN_SIZE:
+                        archive.write(b'\0' * (align - offset % align))
+                        offset += align - offset % align
+
+                    try:
+                        if prefetched is not None:
+                            (data, digest) = prefetched
+                            length = len(data)
+                            if not dedup or (length, digest) not in written:
+                                archive.write(data)
+                        elif dedup:
+                            target = _HashingWriter(archive)
+                            length = self.copy(file, target)
+                            digest = target.digest()
+                        else:
+                            length = self.copy(file, archive)
+                    except (IOError, OSError) as e:
+                        if source is not None or not isinstance(self.files.get(file), DiskFile):
+                            raise
+                        self.skip_file(file, e, archive, start)
+                        offset = start
+                        continue
+
+                    if dedup:
+                        if (length, digest) in written:
+                            # Drop whatever we just wrote, and point at the first copy instead.
+                            self.verbose_print('File {0} is a duplicate, sharing its contents...'.format(_printable(file)))
+                            archive.seek(start)
+                            archive.truncate()
+                            offset = start
+                            indexes[file] = self.obfuscate_index([ (written[(length, digest)], length) ])
+                            if source is not None:
+                                copied[source] = (written[(length, digest)], length)
+                            self.deduplicated_files += 1
+                            self.deduplicated_bytes += length
+                            continue
+                        written[(length, digest)] = offset
+
+                    # Update index.
+                    indexes[file] = self.obfuscate_index([ (offset, length) ])
+                    if source is not None:
+                        copied[source] = (offset, length)
+                    offset += length
+
+                # Write the indexes.
+                self.verbose_print('Writing archive index to archive file...')
+                archive.write(codecs.encode(pickle.dumps(indexes, self.PICKLE_PROTOCOL), 'zlib'))
+                # Now write the header.
+                self.verbose_print('Writing header to archive file... (version = RPAv{0})'.format(self.version))
+                archive.seek(0)
+                archive.write(self.build_header(offset))
+
+            # Let go of the archive we read from before replacing it, some platforms refuse to replace open files.
+            self.unmap()
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+            os.replace(temporary, filename)
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
 
         # Reload the file in our inner database.
         self.load(filename)
 
+# Read an access trace for the 'trace' layout: a text file listing archive file names in the order they are accessed,
+# one per line. Empty lines and lines starting with '#' are skipped.
+def load_access_trace(path):
+    with io.open(path, 'r', encoding='utf-8') as file:
+        return [ line.strip() for line in file if line.strip() and not line.startswith('#') ]
+
+# Find the archives in a game directory, in the order Ren'Py looks files up in them. Like Ren'Py, only archives directly
+# in the directory count, and their file names are sorted and then reversed, so when several archives contain the same
+# file, the one whose name sorts last wins.
+def find_archives(directory):
+    archives = [ name for name in sorted(os.listdir(directory))
+        if name.endswith('.rpa') and os.path.isfile(os.path.join(directory, name)) ]
+    archives.reverse()
+    return [ os.path.join(directory, archive) for archive in archives ]
+
+# Header lines of archives as Ren'Py writes them, anything else is reported as non-standard by sniff_archive().
+_STANDARD_HEADERS = {
+    2: re.compile(br'RPA-2\.0 [0-9a-f]{16}\n\Z'),
+    3: re.compile(br'RPA-3\.0 [0-9a-f]{16} [0-9a-f]{8}\n\Z'),
+    3.2: re.compile(br'RPA-3\.2 [0-9a-f]{16}( [0-9a-f]{8})+\n\Z'),
+}
+
+# Describe an archive file from its header line only, without reading its index. Returns a dict with the path, version
+# (2, 3, 3.2, 1 for .rpi indexes and the .rpa data files next to them, or None if unknown), index offset, key, index
+# size (from the index offset to the end of the file), whether the header is non-standard, and an error message or None.
+def sniff_archive(path):
+    record = { 'path': path, 'version': None, 'offset': None, 'key': None, 'index_size': None, 'nonstandard': False,
+        'error': None }
+    try:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            header = file.readline(256)
+    except (IOError, OSError) as e:
+        record['error'] = str(e)
+        return record
+
+    magic = header[:8].decode('latin-1')
+    if magic in (RenPyArchive.RPA2_MAGIC, RenPyArchive.RPA3_MAGIC, RenPyArchive.RPA3_2_MAGIC):
+        record['version'] = { RenPyArchive.RPA2_MAGIC: 2, RenPyArchive.RPA3_MAGIC: 3, RenPyArchive.RPA3_2_MAGIC: 3.2 }[magic]
+        record['nonstandard'] = not _STANDARD_HEADERS[record['version']].match(header)
+        values = header.split()
+        try:
+            record['offset'] = int(values[1], 16)
+            if record['version'] != 2:
+                record['key'] = 0
+                for subkey in values[2 if record['version'] == 3 else 3:]:
+                    record['key'] ^= int(subkey, 16)
+        except (IndexError, ValueError):
+            record['error'] = 'malformed header'
+            return record
+        if record['offset'] > size or record['offset'] < len(header):
+            record['error'] = 'index offset outside of the file'
+        else:
+            record['index_size'] = size - record['offset']
+    elif path.lower().endswith('.rpi'):
+        (record['version'], record['offset'], record['index_size']) = (1, 0, size)
+    elif os.path.exists(os.path.splitext(path)[0] + '.rpi'):
+        # Data file of a version 1 archive, which has no header.
+        record['version'] = 1
+    else:
+        record['nonstandard'] = True
+        record['error'] = 'unknown header'
+    return record
+
+# Describe all .rpa and .rpi files below a directory with sniff_archive(), in a pool of jobs threads. Yields records in
+# path order.
+def sniff_archives(directory, jobs = 1):
+    paths = []
+    for (root, directories, files) in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(('.rpa', '.rpi')))
+    for (path, record, error) in _ordered_map(sniff_archive, sorted(paths), jobs):
+        yield record
+
+# Expand FILE arguments with a PathTrie of the file names to choose from: arguments ending in '/' select the files in
+# that directory, and with mode 'glob' or 'regex' arguments are patterns selecting the files matching them. Other
+# arguments, file names or ARCHIVE=REAL mappings, are passed through.
+def expand_selection(tree, files, mode = 'prefix'):
+    selected = []
+    for filename in files:
+        filename = _unicode(filename)
+        if mode == 'glob':
+            selected.extend(tree.glob(filename))
+        elif mode == 'regex':
+            selected.extend(tree.regex(filename))
+        elif filename.endswith('/'):
+            selected.extend(tree.prefix(filename))
+        else:
+            selected.append(filename)
+    return selected
+
+# Plan the extraction of opened archives, given in lookup order: every file is taken from the first archive that has it.
+# Only files in selection, a list as returned by expand_selection(), are planned if it is given. Returns a list of
+# (archive, filenames) pairs.
+def plan_extraction(archives, selection = None):
+    if selection is not None:
+        selection = set(filename.partition('=')[2] or filename for filename in selection)
+    seen = set()
+    plan = []
+    for archive in archives:
+        files = [ filename for filename in archive.list() if filename not in seen
+            and (selection is None or filename in selection) ]
+        seen.update(files)
+        plan.append((archive, files))
+    return plan
+
+# Extract opened archives, given in lookup order, into one directory as planned by plan_extraction(), optionally only
+# the files in selection, extracting REAL as ARCHIVE for ARCHIVE=REAL mappings in it. All output directories are
+# created up front, and all archives share one pool of jobs threads.
+# Yields (archive, filename, error) for every file, error being None on success.
+def extract_archives(archives, output, jobs = 1, incremental = False, checksum = False, digests = None, algorithm = 'blake2b',
+        selection = None):
+    outfiles = dict(reversed(filename.split('=', 1)) for filename in selection or () if '=' in filename)
+    plan = [ (archive, [ (outfiles.get(filename, filename), filename) for filename in files ])
+        for (archive, files) in plan_extraction(archives, selection) ]
+
+    directories = set()
+    for (archive, pairs) in plan:
+        for (outfile, filename) in pairs:
+            directories.add(os.path.dirname(os.path.join(output, outfile)))
+    for directory in sorted(directories):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+    try:
+        for (archive, pairs) in plan:
+            for (filename, e) in archive.extract(pairs, output, jobs=jobs,
+                    incremental=incremental, checksum=checksum, pool=pool, directories=directories, digests=digests,
+                    algorithm=algorithm):
+                yield (archive, filename, e)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+# Compare the files of two opened archives, yielding (filename, status) sorted by file name, status being 'added',
+# 'removed', 'modified' or 'unchanged'. Indexes are compared first: only files with the same size in both archives are
+# read, and their digests compared, in a pool of jobs threads. Memory-mapped archives are hashed in place.
+def diff_archives(old, new, jobs = 1):
+    (old_files, new_files) = (set(old.list()), set(new.list()))
+    status = dict.fromkeys(old_files - new_files, 'removed')
+    status.update(dict.fromkeys(new_files - old_files, 'added'))
+
+    candidates = []
+    for filename in old_files & new_files:
+        if old.size(filename) != new.size(filename):
+            status[filename] = 'modified'
+        else:
+            candidates.append(filename)
+    candidates.sort(key=new.offset)
+
+    def same(filename):
+        return old.digest(filename) == new.digest(filename)
+
+    for (filename, result, error) in _ordered_map(same, candidates, jobs):
+        if error is not None:
+            raise error
+        status[filename] = 'unchanged' if result else 'modified'
+
+    for filename in sorted(status):
+        yield (filename, status[filename])
+
+# Delta patches rebuild a new archive from an old one. They start with PATCH_MAGIC and PATCH_HEADER: the size of the new
+# archive, the size and fingerprint of the old one, the digest of the whole new archive, and the number of operations.
+# Then follow the operations, and the data they refer to. Every operation appends length bytes at offset, either in the
+# old archive (PATCH_COPY) or in the patch data (PATCH_DATA), to the new archive.
+PATCH_MAGIC = b'RPAPATCH2\n'
+PATCH_HEADER = struct.Struct('<QQ20s20sI')
+PATCH_OPERATION = struct.Struct('<BQQ')
+PATCH_COPY = 0
+PATCH_DATA = 1
+# Bytes at the start and at the end of an archive, its header and index, that are hashed into its fingerprint.
+PATCH_FINGERPRINT_SIZE = 64 * 1024
+
+# Identify an opened archive for delta patches by its size and the digest of its header and index, without reading it
+# all. Returns (size, fingerprint). This only tells quickly whether a patch is meant for an archive, it does not prove
+# the archive is intact: that is up to the digest of the rebuilt archive.
+def _archive_fingerprint(archive):
+    size = os.fstat(archive.handle.fileno()).st_size
+    length = min(size, PATCH_FINGERPRINT_SIZE)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(archive.read_range(0, length))
+    digest.update(archive.read_range(size - length, length))
+    return (size, digest.digest())
+
+# Ranges (offset, length) of the file data stored in an opened archive, without prefixes.
+def _stored_ranges(archive):
+    ranges = set()
+    for filename in archive.indexes:
+        (offset, length, prefix) = archive.entry_range(filename)
+        ranges.add((offset, length))
+    return ranges
+
+# Copy length bytes at offset, read in chunks with read(offset, length), to a file object, or only read them if target
+# is None, hashing them into digest on the way. name is only used in error messages.
+def _copy_hashing(read, offset, length, target, digest, name, chunk_size = 1024 * 1024):
+    while length > 0:
+        chunk = read(offset, min(length, chunk_size))
+        if not chunk:
+            raise IOError(errno.EIO, 'unexpected end of file {0}'.format(_printable(name)))
+        digest.update(chunk)
+        if target is not None:
+            target.write(chunk)
+        offset += len(chunk)
+        length -= len(chunk)
+
+# Write a delta patch from the opened archive old to the opened archive new into path. File data of new that is stored
+# in old as well, found by comparing digests of ranges of the same size, is copied from old when the patch is applied;
+# everything else, including the header, padding and index of new, is stored in the patch. Files are hashed in a pool
+# of jobs threads, and all of new is hashed while the patch is written. Returns (bytes copied from old, bytes stored in
+# the patch).
+def create_patch(old, new, path, jobs = 1):
+    (old_size, fingerprint) = _archive_fingerprint(old)
+    new_size = os.fstat(new.handle.fileno()).st_size
+    ranges = sorted(_stored_ranges(new))
+
+    # Only ranges of old with a size found in new can be reused.
+    sizes = set(length for (offset, length) in ranges)
+    candidates = sorted(entry for entry in _stored_ranges(old) if entry[1] in sizes)
+    stored = {}
+    for ((offset, length), digest, error) in _ordered_map(lambda entry: old.digest_range(entry[0], entry[1]), candidates, jobs):
+        if error is not None:
+            raise error
+        stored.setdefault((length, digest), offset)
+    sizes = set(length for (offset, length) in candidates)
+    matches = {}
+    for ((offset, length), digest, error) in _ordered_map(lambda entry: new.digest_range(entry[0], entry[1]),
+            [ entry for entry in ranges if entry[1] in sizes ], jobs):
+        if error is not None:
+            raise error
+        if (length, digest) in stored:
+            matches[offset] = stored[(length, digest)]
+
+    # Cover the new archive with operations, merging adjacent ones. The number of bytes stored in the patch so far is
+    # kept in patch_size.
+    operations = []
+    patch_size = [ 0 ]
+    def emit(kind, offset, length):
+        if operations and operations[-1][0] == kind and operations[-1][1] + operations[-1][2] == offset:
+            operations[-1][2] += length
+        else:
+            operations.append([kind, offset, length])
+    def emit_data(offset, length):
+        if length > 0:
+            emit(PATCH_DATA, patch_size[0], length)
+            patch_size[0] += length
+
+    position = 0
+    for (offset, length) in ranges:
+        if offset + length <= position:
+            continue
+        if offset < position:
+            # Overlapping files, keep the part not covered yet.
+            emit_data(position, offset + length - position)
+        else:
+            emit_data(position, offset - position)
+            if offset in matches and length > 0:
+                emit(PATCH_COPY, matches[offset], length)
+            else:
+                emit_data(offset, length)
+        position = offset + length
+    emit_data(position, new_size - position)
+
+    try:
+        with open(path + '.tmp', 'wb', buffering=0) as patch:
+            patch.write(PATCH_MAGIC + PATCH_HEADER.pack(new_size, old_size, fingerprint, b'\0' * 20, len(operations)))
+            patch.write(b''.join(PATCH_OPERATION.pack(*operation) for operation in operations))
+            # Read all of new in order, hashing it and storing the ranges the patch holds.
+            digest = hashlib.blake2b(digest_size=20)
+            position = 0
+            for (kind, offset, length) in operations:
+                _copy_hashing(new.read_range, position, length, patch if kind == PATCH_DATA else None, digest, new.file,
+                    new.COPY_CHUNK_SIZE)
+                position += length
+            patch.seek(len(PATCH_MAGIC))
+            patch.write(PATCH_HEADER.pack(new_size, old_size, fingerprint, digest.digest(), len(operations)))
+        os.replace(path + '.tmp', path)
+    except:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+
+    copied = sum(length for (kind, offset, length) in operations if kind == PATCH_COPY)
+    return (copied, new_size - copied)
+
+# Rebuild the new archive of a delta patch from the opened archive old into output, byte for byte. The rebuilt archive
+# is hashed while it is written, and only replaces output if it matches the digest in the patch. Raises ValueError if
+# the patch is not for old, or old is not the archive the patch was made from.
+def apply_patch(old, path, output):
+    with open(path, 'rb', buffering=0) as patch:
+        header = patch.read(len(PATCH_MAGIC) + PATCH_HEADER.size)
+        if not header.startswith(PATCH_MAGIC) or len(header) != len(PATCH_MAGIC) + PATCH_HEADER.size:
+            raise ValueError('{0} is not an archive patch'.format(path))
+        (new_size, old_size, fingerprint, expected, count) = PATCH_HEADER.unpack_from(header, len(PATCH_MAGIC))
+        if _archive_fingerprint(old) != (old_size, fingerprint):
+            raise ValueError('patch {0} does not apply to archive {1}'.format(path, old.file))
+        operations = patch.read(count * PATCH_OPERATION.size)
+        if len(operations) != count * PATCH_OPERATION.size:
+            raise ValueError('truncated archive patch {0}'.format(path))
+        start = len(header) + len(operations)
+
+        def read_patch(offset, length):
+            if hasattr(os, 'pread'):
+                return os.pread(patch.fileno(), length, start + offset)
+            patch.seek(start + offset)
+            return patch.read(length)
+
+        try:
+            with open(output + '.tmp', 'wb', buffering=0) as target:
+                digest = hashlib.blake2b(digest_size=20)
+                for (kind, offset, length) in PATCH_OPERATION.iter_unpack(operations):
+                    if kind == PATCH_COPY:
+                        _copy_hashing(old.read_range, offset, length, target, digest, old.file, old.COPY_CHUNK_SIZE)
+                    elif kind == PATCH_DATA:
+                        _copy_hashing(read_patch, offset, length, target, digest, path, old.COPY_CHUNK_SIZE)
+                    else:
+                        raise ValueError('unknown operation in archive patch {0}'.format(path))
+                if target.tell() != new_size:
+                    raise ValueError('archive patch {0} does not add up to {1} bytes'.format(path, new_size))
+                if digest.digest() != expected:
+                    raise ValueError('archive rebuilt with patch {0} does not match, archive {1} is not the one the '
+                        'patch was made from'.format(path, old.file))
+        except:
+            if os.path.exists(output + '.tmp'):
+                os.remove(output + '.tmp')
+            raise
+
+    # The old archive may be replaced by the new one.
+    if os.path.abspath(output) == os.path.abspath(old.file):
+        old.close()
+    os.replace(output + '.tmp', output)
+
+# Read-only view of the files in a set of archives, such as all archives of a game, as Ren'Py sees them: the indexes
+# are merged once, with every file taken from the first archive in lookup order that has it. Only the max_open most
+# recently used archives are kept open. Archives can be given as a game directory, a single archive, or as a list in
+# lookup order.
+class ArchiveSet(object):
+    def __init__(self, archives, max_open = 8, **options):
+        if isinstance(archives, str):
+            archives = find_archives(archives) if os.path.isdir(archives) else [ archives ]
+
+        self.max_open = max(1, max_open)
+        self.archives = []
+        self.index = {}
+        self.open_archives = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+        for filename in archives:
+            archive = RenPyArchive(filename, **options)
+            archive.close()
+            self.archives.append(archive)
+            for name in archive.list():
+                if name not in self.index:
+                    self.index[name] = archive
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for archive in self.archives:
+            archive.close()
+        self.open_archives.clear()
+
+    # Converts a filename to archive format.
+    def convert_filename(self, filename):
+        (drive, filename) = os.path.splitdrive(os.path.normpath(_unicode(filename)).replace(os.sep, '/'))
+        return filename
+
+    # Find the archive holding a file.
+    def archive(self, filename):
+        filename = self.convert_filename(filename)
+        if filename not in self.index:
+            raise IOError(errno.ENOENT, 'the requested file {0} does not exist in the given Ren\'Py archives'.format(
+                _printable(filename)))
+        return self.index[filename]
+
+    # Open an archive for reading, closing the least recently used one if too many are open.
+    def acquire(self, archive):
+        if archive.file in self.open_archives:
+            self.open_archives.move_to_end(archive.file)
+            return archive
+        archive.reopen()
+        self.open_archives[archive.file] = archive
+        while len(self.open_archives) > self.max_open:
+            (_, oldest) = self.open_archives.popitem(last=False)
+            oldest.close()
+        return archive
+
+    def list(self):
+        return list(self.index.keys())
+
+    def exists(self, filename):
+        return self.convert_filename(filename) in self.index
+
+    def read(self, filename):
+        archive = self.archive(filename)
+        with self.lock:
+            data = self.acquire(archive).read(filename)
+            # Memory-mapped data would not survive closing its archive.
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            return data
+
+    # Open a file for reading as a file object. Its archive is opened again when needed while reading.
+    def open(self, filename):
+        archive = self.archive(filename)
+        with self.lock:
+            entry = self.acquire(archive).open(filename)
+        if not isinstance(entry, ArchiveEntry):
+            return entry
+
+        offset = archive.indexes[entry.name][0][0]
+        def reader(position, buffer):
+            with self.lock:
+                return self.acquire(archive).readinto_range(offset + position, buffer)
+        entry.reader = reader
+        return entry
+
 if __name__ == "__main__":
     import argparse
 
@@ -319,20 +2595,48 @@ if __name__ == "__main__":
         epilog='The FILE argument can optionally be in ARCHIVE=REAL format, mapping a file in the archive file system to a file on your real file system. An example of this: rpatool -x test.rpa script.rpyc=/home/foo/test.rpyc',
         add_help=False)
 
-    parser.add_argument('archive', metavar='ARCHIVE', help='The Ren\'py archive file to operate on.')
-    parser.add_argument('files', metavar='FILE', nargs='*', action='append', help='Zero or more files to operate on.')
+    parser.add_argument('archive', metavar='ARCHIVE', help='The Ren\'py archive file to operate on. When extracting or listing, this can also be a game directory, to work on all files of all .rpa archives in it, taking each file from the archive Ren\'Py would load it from.')
+    parser.add_argument('files', metavar='FILE', nargs='*', action='append', help='Zero or more files to operate on. When extracting or listing, FILEs ending in \'/\' select whole directories.')
 
     parser.add_argument('-l', '--list', action='store_true', help='List files in archive ARCHIVE.')
     parser.add_argument('-x', '--extract', action='store_true', help='Extract FILEs from ARCHIVE.')
     parser.add_argument('-c', '--create', action='store_true', help='Creative ARCHIVE from FILEs.')
     parser.add_argument('-d', '--delete', action='store_true', help='Delete FILEs from ARCHIVE.')
     parser.add_argument('-a', '--append', action='store_true', help='Append FILEs to ARCHIVE.')
+    parser.add_argument('-e', '--export', metavar='OUTPUT', help='Export FILEs (default: all files) from ARCHIVE into a tar archive, or an uncompressed zip archive if OUTPUT ends in .zip. Use - to write a tar archive to standard output.')
+    parser.add_argument('--compact', action='store_true', help='Rewrite ARCHIVE, reclaiming space left behind by in-place changes. Use with --layout and --align to repack ARCHIVE for faster reads.')
+    parser.add_argument('--diff', action='store_true', help='Compare ARCHIVE with the archive given as FILE, listing the files added, removed, modified and unchanged in FILE.')
+    parser.add_argument('--create-patch', metavar='PATCH', help='Write a delta patch from ARCHIVE to the archive given as FILE into PATCH, holding only what is not in ARCHIVE already.')
+    parser.add_argument('--apply-patch', metavar='PATCH', help='Rebuild the new archive of PATCH from ARCHIVE, into the output file or in place of ARCHIVE.')
+    parser.add_argument('--sniff', action='store_true', help='Print the version, index offset, key and index size of ARCHIVE, or of every .rpa and .rpi file below ARCHIVE if it is a directory, reading only their header lines.')
+    parser.add_argument('--catalog', metavar='CATALOG', help='Write the type, image size, audio codec and duration, and font family of FILEs (default: all files) in ARCHIVE to CATALOG, as CSV, SQLite (.db, .sqlite) or JSON, reading only file headers.')
+    parser.add_argument('--manifest', metavar='MANIFEST', help='Write the size and digest of FILEs (default: all files) in ARCHIVE to MANIFEST, on its own or when listing or extracting. When extracting, files are hashed as they are written.')
+    parser.add_argument('--verify', metavar='MANIFEST', help='Check FILEs (default: all files listed in MANIFEST) in ARCHIVE against MANIFEST. ARCHIVE can also be a directory files were extracted into.')
+
+    parser.add_argument('-g', '--glob', action='store_true', help='Treat FILEs as glob patterns when extracting or listing; patterns without a \'/\' match in any directory, and \'**\' matches any number of directories.')
+    parser.add_argument('-r', '--regex', action='store_true', help='Treat FILEs as regular expressions, matched from the start of file names, when extracting or listing.')
 
     parser.add_argument('-2', '--two', action='store_true', help='Use the RPAv2 format for creating/appending to archives.')
     parser.add_argument('-3', '--three', action='store_true', help='Use the RPAv3 format for creating/appending to archives (default).')
 
+    parser.add_argument('--layout', choices=RenPyArchive.LAYOUTS, help='Order files when saving ARCHIVE: grouped by directory and type (path), small files first (size), or in the order of an access trace (trace).')
+    parser.add_argument('--trace', metavar='TRACE', help='Access trace for --layout trace and --benchmark: a text file listing archive file names in the order they are read, one per line.')
+    parser.add_argument('--align', metavar='BYTES', type=int, default=0, help='Start files of 64 KiB and more at a multiple of BYTES when saving ARCHIVE, e.g. 4096 to align them to memory pages.')
+    parser.add_argument('--page-align', action='store_const', dest='align', const=mmap.PAGESIZE, help='Like --align, with the page size of this system.')
+    parser.add_argument('--benchmark', action='store_true', help='Time reading FILEs (default: the files in TRACE, or all files in the order they are stored) from ARCHIVE one at a time, starting from a cold page cache where possible.')
+    parser.add_argument('--dedup', action='store_true', help='Store files with identical contents only once when saving ARCHIVE, and report the space saved.')
     parser.add_argument('-k', '--key', metavar='KEY', help='The obfuscation key used for creating RPAv3 archives, in hexadecimal (default: 0xDEADBEEF).')
     parser.add_argument('-p', '--padding', metavar='COUNT', help='The maximum number of bytes of padding to add between files (default: 0).')
+    parser.add_argument('-i', '--in-place', action='store_true', help='Append or delete FILEs by only appending to ARCHIVE and rewriting its index, keeping its format version.')
+    parser.add_argument('--salvage', action='store_true', help='Recover files from ARCHIVE without reading its index, which may be damaged or missing, by looking for PNG, JPEG, Ogg, WebP, font and compiled script signatures. Recovered files are named by their offset.')
+    parser.add_argument('--index-cache', metavar='DIRECTORY', help='Cache parsed archive indexes in DIRECTORY, so reopening an unchanged archive skips parsing its index.')
+    parser.add_argument('--compact-index', action='store_true', help='Keep the index of ARCHIVE in a compact form, using less memory for large archives.')
+    parser.add_argument('-m', '--mmap', action='store_true', help='Memory-map ARCHIVE and read files from it without copying.')
+    parser.add_argument('-j', '--jobs', metavar='COUNT', type=int, default=1, help='The number of threads writing files when extracting, or reading them when creating or appending (default: 1).')
+    parser.add_argument('-u', '--incremental', action='store_true', help='When extracting, skip files that are unchanged since the last extraction into the output directory, and remove files that are no longer in ARCHIVE.')
+    parser.add_argument('--checksum', action='store_true', help='With --incremental, compare file contents instead of trusting unchanged archive ranges.')
+    parser.add_argument('--digest', choices=DIGEST_ALGORITHMS, default='blake2b', help='The digest algorithm used by --manifest (default: blake2b).')
+    parser.add_argument('--no-kernel-copy', action='store_true', help='Read extracted files through Python instead of having the kernel copy them (copy_file_range/sendfile).')
     parser.add_argument('-o', '--outfile', help='An alternative output archive file when appending to or deleting from archives, or output directory when extracting.')
 
     parser.add_argument('-h', '--help', action='help', help='Print this help and exit.')
@@ -340,6 +2644,10 @@ if __name__ == "__main__":
     parser.add_argument('-V', '--version', action='version', version='rpatool v0.8', help='Show version information.')
     arguments = parser.parse_args()
 
+    # Exporting to standard output: keep messages out of the exported data, from opening the archive on.
+    if arguments.export == '-':
+        arguments.verbose = False
+
     # Determine RPA version.
     if arguments.two:
         version = 2
@@ -373,18 +2681,226 @@ if __name__ == "__main__":
             else:
                 output = _unicode(arguments.archive)
 
+    if arguments.in_place and (arguments.create or output != archive):
+        print('In-place changes can only be made to an existing archive, without a different output file.', file=sys.stderr)
+        sys.exit(1)
+
     # Normalize files.
     if len(arguments.files) > 0 and isinstance(arguments.files[0], list):
         arguments.files = arguments.files[0]
 
+    def open_archive(filename):
+        if arguments.salvage:
+            archive = RenPyArchive(padlength=padding, key=key, version=version, verbose=arguments.verbose)
+            archive.salvage(filename)
+            return archive
+        archive = RenPyArchive(filename, padlength=padding, key=key, version=version, verbose=arguments.verbose, use_mmap=arguments.mmap,
+            index_cache=arguments.index_cache, compact_index=arguments.compact_index)
+        if arguments.no_kernel_copy:
+            archive.kernel_copy = False
+        return archive
+
+    # Describe archives from their header lines, one per line.
+    if arguments.sniff:
+        records = sniff_archives(archive, jobs=arguments.jobs) if os.path.isdir(archive) else [ sniff_archive(archive) ]
+        print('path\tversion\toffset\tkey\tindex size\tnon-standard')
+        for record in records:
+            print('\t'.join([
+                _printable(record['path']),
+                str(record['version']) if record['version'] is not None else '?',
+                '0x{0:x}'.format(record['offset']) if record['offset'] is not None else '-',
+                '0x{0:08x}'.format(record['key']) if record['key'] is not None else '-',
+                str(record['index_size']) if record['index_size'] is not None else '-',
+                'yes' if record['nonstandard'] else 'no',
+            ]) + ('\t' + record['error'] if record['error'] else ''))
+        sys.exit(0)
+
+    # Check an archive, or the files extracted into a directory, against an integrity manifest.
+    if arguments.verify:
+        try:
+            (algorithm, expected) = load_digest_manifest(arguments.verify)
+        except (IOError, OSError, ValueError) as e:
+            print('Could not read manifest {0}: {1}'.format(arguments.verify, e), file=sys.stderr)
+            sys.exit(1)
+
+        if os.path.isdir(archive):
+            filenames = [ _unicode(filename) for filename in arguments.files ] or sorted(expected)
+            results = digest_directory(archive, filenames, algorithm, jobs=arguments.jobs)
+        else:
+            try:
+                archive = open_archive(archive)
+            except (IOError, ValueError) as e:
+                print('Could not open archive file {0} for reading: {1}'.format(archive, e), file=sys.stderr)
+                sys.exit(1)
+            filenames = [ _unicode(filename) for filename in arguments.files ] or archive.list()
+            results = archive.digests(filenames, algorithm, jobs=arguments.jobs)
+        if arguments.files:
+            expected = dict((filename, expected[filename]) for filename in filenames if filename in expected)
+
+        (checked, failed) = (0, 0)
+        for (filename, problem) in verify_digests(expected, results):
+            checked += 1
+            if problem is not None:
+                failed += 1
+                print('{0}: {1}'.format(_printable(filename), problem), file=sys.stderr)
+            elif arguments.verbose:
+                print('{0}: OK'.format(_printable(filename)))
+        print('Verified {0} files, {1} failed.'.format(checked, failed))
+        sys.exit(1 if failed else 0)
+
+    # Compare two archives, both memory-mapped so the files to check are hashed in place.
+    if arguments.diff:
+        if len(arguments.files) != 1:
+            print('Comparing archives needs exactly one other archive file.', file=sys.stderr)
+            sys.exit(1)
+        arguments.mmap = True
+        try:
+            archives = [ open_archive(filename) for filename in (archive, _unicode(arguments.files[0])) ]
+        except (IOError, ValueError) as e:
+            print('Could not open archive file for reading: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+
+        counts = collections.Counter()
+        try:
+            for (filename, status) in diff_archives(archives[0], archives[1], jobs=arguments.jobs):
+                counts[status] += 1
+                print('{0} {1}'.format(status, _printable(filename)))
+        except Exception as e:
+            print('Could not compare archives: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        print('{0} added, {1} removed, {2} modified, {3} unchanged.'.format(counts['added'], counts['removed'],
+            counts['modified'], counts['unchanged']), file=sys.stderr)
+        sys.exit(0)
+
+    # Write a delta patch between two archives, or rebuild an archive from one.
+    if arguments.create_patch:
+        if len(arguments.files) != 1:
+            print('Creating a patch needs exactly one new archive file.', file=sys.stderr)
+            sys.exit(1)
+        try:
+            archives = [ open_archive(filename) for filename in (archive, _unicode(arguments.files[0])) ]
+        except (IOError, ValueError) as e:
+            print('Could not open archive file for reading: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        try:
+            (copied, stored) = create_patch(archives[0], archives[1], arguments.create_patch, jobs=arguments.jobs)
+        except Exception as e:
+            print('Could not create patch: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        print('Patch reuses {0} bytes of the old archive and stores {1} bytes.'.format(copied, stored))
+        sys.exit(0)
+    elif arguments.apply_patch:
+        try:
+            apply_patch(open_archive(archive), arguments.apply_patch, output)
+        except (IOError, OSError, ValueError) as e:
+            print('Could not apply patch: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    # Access trace for laying out or benchmarking archives.
+    trace = None
+    if arguments.trace:
+        try:
+            trace = load_access_trace(arguments.trace)
+        except (IOError, OSError, ValueError) as e:
+            print('Could not read access trace {0}: {1}'.format(arguments.trace, e), file=sys.stderr)
+            sys.exit(1)
+
+    # Sizes and digests of files, by name, for --manifest, which hashes files when extracting, listing or on its own.
+    if arguments.manifest and not (arguments.create or arguments.append or arguments.delete or arguments.compact or arguments.export
+            or arguments.catalog):
+        digests = {}
+    else:
+        digests = None
+
+    # Describe files in a catalog, collecting records of all archives first.
+    def write_catalog(sources):
+        records = []
+        for (source, files) in sources:
+            for (filename, record, e) in source.catalog(files, jobs=arguments.jobs):
+                if e is not None:
+                    print('Could not read file {0} from archive {1}: {2}'.format(filename, source.file, e), file=sys.stderr)
+                else:
+                    records.append(record)
+        try:
+            save_catalog(arguments.catalog, records)
+        except (IOError, OSError) as e:
+            print('Could not write catalog {0}: {1}'.format(arguments.catalog, e), file=sys.stderr)
+            sys.exit(1)
+
+    # How FILE arguments select files.
+    selection_mode = 'glob' if arguments.glob else 'regex' if arguments.regex else 'prefix'
+
+    # A game directory extracts, lists or catalogs the files of all its archives, as Ren'Py would see them.
+    if archive is not None and os.path.isdir(archive) and (arguments.extract or arguments.list or arguments.catalog):
+        archives = []
+        for filename in find_archives(archive):
+            try:
+                archives.append(open_archive(filename))
+            except (IOError, ValueError) as e:
+                print('Could not open archive file {0} for reading: {1}'.format(filename, e), file=sys.stderr)
+
+        # Select FILEs among the files of all archives, reporting the ones none of them has.
+        selection = None
+        if len(arguments.files) > 0:
+            names = set(filename for source in archives for filename in source.list())
+            selection = expand_selection(PathTrie(names), arguments.files, selection_mode)
+            for filename in selection:
+                if (filename.partition('=')[2] or filename) not in names:
+                    print('Could not find file {0} in the archives of {1}.'.format(_printable(filename), archive), file=sys.stderr)
+        plan = plan_extraction(archives, selection)
+
+        if arguments.catalog:
+            write_catalog(plan)
+        elif arguments.extract:
+            if not os.path.exists(output):
+                os.makedirs(output)
+            for (source, filename, e) in extract_archives(archives, output, jobs=arguments.jobs,
+                    incremental=arguments.incremental, checksum=arguments.checksum, digests=digests,
+                    algorithm=arguments.digest, selection=selection):
+                if e is not None:
+                    print('Could not extract file {0} from archive {1}: {2}'.format(filename, source.file, e), file=sys.stderr)
+        else:
+            for file in sorted(filename for (source, files) in plan for filename in files):
+                print(file)
+            if digests is not None:
+                for (source, files) in plan:
+                    for (filename, size, digest, e) in source.digests(files, arguments.digest, jobs=arguments.jobs):
+                        if e is not None:
+                            print('Could not hash file {0} from archive {1}: {2}'.format(filename, source.file, e), file=sys.stderr)
+                        else:
+                            digests[filename] = (size, digest)
+        if digests is not None:
+            save_digest_manifest(arguments.manifest, arguments.digest, digests)
+        sys.exit(0)
+
     try:
-        archive = RenPyArchive(archive, padlength=padding, key=key, version=version, verbose=arguments.verbose)
-    except IOError as e:
+        archive = open_archive(archive)
+    except (IOError, ValueError) as e:
         print('Could not open archive file {0} for reading: {1}'.format(archive, e), file=sys.stderr)
         sys.exit(1)
 
+    # Save the archive, reporting what deduplication saved.
+    def save_archive(output):
+        layout = arguments.layout or ('trace' if arguments.trace else None)
+        archive.save(output, dedup=arguments.dedup, jobs=arguments.jobs, layout=layout, trace=trace, align=arguments.align)
+        if arguments.dedup:
+            print('Deduplicated {0} files, saving {1} bytes.'.format(archive.deduplicated_files, archive.deduplicated_bytes))
+
+    # Hash files for --manifest.
+    def hash_files(files):
+        for (filename, size, digest, e) in archive.digests(files, arguments.digest, jobs=arguments.jobs):
+            if e is not None:
+                print('Could not hash file {0} from archive: {1}'.format(filename, e), file=sys.stderr)
+            else:
+                digests[filename] = (size, digest)
+
+    # Expand FILE arguments ending in '/' to the files in that directory, and glob patterns or regular expressions to
+    # the files matching them; other arguments are passed through.
+    def select_files(files):
+        return expand_selection(archive.tree(), files, selection_mode)
+
     if arguments.create or arguments.append:
-        # We need this seperate function to recursively process directories.
         def add_file(filename):
             # If the archive path differs from the actual file path, as given in the argument,
             # extract the archive path and actual file path.
@@ -393,25 +2909,35 @@ if __name__ == "__main__":
             else:
                 outfile = filename
 
+            def report(filename, e):
+                print('Could not add file {0} to archive: {1}'.format(filename, e), file=sys.stderr)
+
             if os.path.isdir(filename):
-                for file in os.listdir(filename):
-                    # We need to do this in order to maintain a possible ARCHIVE=REAL mapping between directories.
-                    add_file(outfile + os.sep + file + '=' + filename + os.sep + file)
+                # Keep a possible ARCHIVE=REAL mapping for the files in the directory.
+                for (outfile, filename, size) in scan_files(outfile, filename, report):
+                    try:
+                        archive.add(outfile, DiskFile(filename, size))
+                    except Exception as e:
+                        report(filename, e)
             else:
                 try:
-                    with open(filename, 'rb') as file:
-                        archive.add(outfile, file.read())
+                    archive.add(outfile, DiskFile(filename))
                 except Exception as e:
-                    print('Could not add file {0} to archive: {1}'.format(filename, e), file=sys.stderr)
+                    report(filename, e)
 
         # Iterate over the given files to add to archive.
         for filename in arguments.files:
             add_file(_unicode(filename))
 
         # Set version for saving, and save.
-        archive.version = version
         try:
-            archive.save(output)
+            if arguments.in_place:
+                archive.save_in_place()
+            else:
+                archive.version = version
+                save_archive(output)
+            for (filename, e) in archive.skipped_files:
+                print('Could not add file {0} to archive: {1}'.format(_printable(filename), e), file=sys.stderr)
         except Exception as e:
             print('Could not save archive file: {0}'.format(e), file=sys.stderr)
     elif arguments.delete:
@@ -423,15 +2949,44 @@ if __name__ == "__main__":
                 print('Could not delete file {0} from archive: {1}'.format(filename, e), file=sys.stderr)
 
         # Set version for saving, and save.
-        archive.version = version
         try:
-            archive.save(output)
+            if arguments.in_place:
+                archive.save_in_place()
+            else:
+                archive.version = version
+                save_archive(output)
         except Exception as e:
             print('Could not save archive file: {0}'.format(e), file=sys.stderr)
+    elif arguments.compact:
+        # Rewrite the archive, keeping its format version unless asked otherwise.
+        if arguments.two or arguments.three:
+            archive.version = version
+        try:
+            save_archive(output)
+        except Exception as e:
+            print('Could not save archive file: {0}'.format(e), file=sys.stderr)
+    elif arguments.export:
+        # Either export the given files, or all files if no files are given.
+        if len(arguments.files) > 0:
+            files = select_files(arguments.files)
+        else:
+            files = archive.list()
+
+        export_format = 'zip' if arguments.export.lower().endswith('.zip') else 'tar'
+        try:
+            if arguments.export == '-':
+                archive.export(sys.stdout.buffer, export_format, files)
+                sys.stdout.buffer.flush()
+            else:
+                with open(arguments.export, 'wb') as target:
+                    archive.export(target, export_format, files)
+        except Exception as e:
+            print('Could not export files from archive: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
     elif arguments.extract:
         # Either extract the given files, or all files if no files are given.
         if len(arguments.files) > 0:
-            files = arguments.files
+            files = select_files(arguments.files)
         else:
             files = archive.list()
 
@@ -439,31 +2994,61 @@ if __name__ == "__main__":
         if not os.path.exists(output):
             os.makedirs(output)
 
-        # Iterate over files to extract.
+        # Map output files to archive files.
+        pairs = []
         for filename in files:
             if filename.find('=') != -1:
                 (outfile, filename) = filename.split('=', 2)
             else:
                 outfile = filename
+            pairs.append((outfile, filename))
 
-            try:
-                contents = archive.read(filename)
-
-                # Create output directory for file if not present.
-                if not os.path.exists(os.path.dirname(os.path.join(output, outfile))):
-                    os.makedirs(os.path.dirname(os.path.join(output, outfile)))
-
-                with open(os.path.join(output, outfile), 'wb') as file:
-                    file.write(contents)
-            except Exception as e:
+        # Extract files, reporting the ones that failed.
+        for (filename, e) in archive.extract(pairs, output, jobs=arguments.jobs, incremental=arguments.incremental,
+                checksum=arguments.checksum, digests=digests, algorithm=arguments.digest):
+            if e is not None:
                 print('Could not extract file {0} from archive: {1}'.format(filename, e), file=sys.stderr)
     elif arguments.list:
-        # Print the sorted file list.
-        list = archive.list()
+        # Print the sorted file list, of the given files if any.
+        if len(arguments.files) > 0:
+            list = select_files(arguments.files)
+        else:
+            list = archive.list()
         list.sort()
         for file in list:
             print(file)
+        if digests is not None:
+            hash_files(list)
+    elif arguments.catalog:
+        # Either describe the given files, or all files if no files are given.
+        if len(arguments.files) > 0:
+            write_catalog([ (archive, select_files(arguments.files)) ])
+        else:
+            write_catalog([ (archive, archive.list()) ])
+    elif arguments.benchmark:
+        # Read the given files, the traced files or all files in the order they are stored.
+        if len(arguments.files) > 0:
+            files = select_files(arguments.files)
+        elif trace is not None:
+            files = [ filename for filename in trace if archive.has_file(filename) ]
+        else:
+            files = sorted(archive.list(), key=archive.offset)
+        (seconds, size, jumps) = archive.benchmark(files)
+        print('Read {0} files, {1} bytes, in {2:.3f} seconds ({3:.1f} MB/s), with {4} non-sequential reads.'.format(
+            len(files), size, seconds, size / max(seconds, 1e-9) / 1e6, jumps))
+    elif arguments.manifest:
+        # Either hash the given files, or all files if no files are given.
+        if len(arguments.files) > 0:
+            hash_files(select_files(arguments.files))
+        else:
+            hash_files(archive.list())
     else:
         print('No operation given :(')
         print('Use {0} --help for usage details.'.format(sys.argv[0]))
 
+    if digests is not None:
+        try:
+            save_digest_manifest(arguments.manifest, arguments.digest, digests)
+        except (IOError, OSError) as e:
+            print('Could not write manifest {0}: {1}'.format(arguments.manifest, e), file=sys.stderr)
+            sys.exit(1)
@@ -91,11 +91,12 @@ def read_ast_from_file(in_file, context):
     # Reads rpyc v1 or v2 file
     # v1 files are just a zlib compressed pickle blob containing some data and the ast
     # v2 files contain a basic archive structure that can be parsed to find the same blob
+    # in_file may also hand out a buffer such as a memoryview (e.g. rpatool's memory-mapped archives)
     raw_contents = in_file.read()
-    file_start = raw_contents[:50]
+    file_start = bytes(raw_contents[:50])
     is_rpyc_v1 = False
 
-    if not raw_contents.startswith(b"RENPY RPC2"):
+    if not file_start.startswith(b"RENPY RPC2"):
         # if the header isn't present, it should be a RPYC V1 file, which is just the blob
         contents = raw_contents
         is_rpyc_v1 = True
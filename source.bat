@@ -96,6 +96,12 @@ IF "%extension%"==".rpyc" (
         python assets\api\unrpyc.py "!cd!\%%f"
     )
 ) ELSE (
+    IF /I "%file%"=="all" (
+        echo.
+        echo [UPD] Extracting files from every .rpa archive to "%outfolder%"...
+        python assets\api\rpatool.py -x ".." -o "%cd%\%outfolder%" -j 4
+        goto :extracted
+    )
     if not exist "..\%file%.rpa" (
         color 04
         echo [ERROR]: File ..\%file%.rpa not found.
@@ -107,6 +113,7 @@ IF "%extension%"==".rpyc" (
     python assets\api\rpatool.py -x "..\%file%%extension%" -o "%cd%\%outfolder%"
 )
 
+:extracted
 echo.
 color 0A
 echo [INFO] Done, %check% 